@@ -0,0 +1,110 @@
+"""
+Corpus-wide counts of a selection of books.
+
+"""
+import os
+import sys
+import argparse
+import time
+
+from src.aggregate import aggregate_counts
+from src.metaquery import meta_query
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        "Sum the counts of a selection of books: total count and number of"
+        " books (document frequency) of every word.")
+    parser.add_argument(
+        "-i", "--ids",
+        help="File with the PG ids of the books, one per line ('-' for stdin)."
+             " Defaults to all books with counts",
+        default="",
+        type=str)
+    parser.add_argument(
+        "-L", "--language",
+        help="Only keep books in this language (two-letter code, e.g. 'en')",
+        default="",
+        type=str)
+    parser.add_argument(
+        "-M", "--metadata",
+        help="Path to the metadata, used with --language",
+        default="metadata/metadata.csv",
+        type=str)
+    parser.add_argument(
+        "-oco", "--output_counts",
+        help="Path to the counts-output of process_data.py (counts_dir)",
+        default='data/counts/',
+        type=str)
+    parser.add_argument(
+        "-cs", "--counts_store",
+        help="Path to a binary counts store (see src.countstore), read"
+             " instead of the counts files",
+        default="",
+        type=str)
+    parser.add_argument(
+        "-w", "--workers",
+        help="Number of worker processes reading counts files",
+        default=1,
+        type=int)
+    parser.add_argument(
+        "-c", "--cache",
+        help="Folder where results are cached, per selection",
+        default="",
+        type=str)
+    parser.add_argument(
+        "-o", "--output",
+        help="Where to write the counts: one 'word<TAB>count<TAB>books' line"
+             " per word, most frequent first",
+        default="counts_total.txt",
+        type=str)
+    parser.add_argument(
+        "-n", "--top",
+        help="Only write the n most frequent words",
+        default=-1,
+        type=int)
+    parser.add_argument(
+        "-q", "--quiet",
+        action="store_true",
+        help="Quiet mode, do not print info, warnings, etc"
+    )
+
+    args = parser.parse_args()
+
+    # select the books
+    if args.ids == "-":
+        PG_ids = [line.strip() for line in sys.stdin if line.strip() != ""]
+    elif args.ids != "":
+        with open(args.ids) as f:
+            PG_ids = [line.strip() for line in f if line.strip() != ""]
+    elif args.counts_store != "":
+        from src.countstore import CountStore
+        PG_ids = list(CountStore(args.counts_store).index)
+    else:
+        PG_ids = sorted(
+            filename.split("_")[0] for filename in os.listdir(args.output_counts)
+            if filename.startswith("PG") and filename.endswith("_counts.txt"))
+    if args.language != "":
+        mq = meta_query(path=args.metadata, filter_exist=False)
+        mq.filter_lang(args.language, how="only")
+        selected = set(mq.get_ids())
+        PG_ids = [PG_id for PG_id in PG_ids if PG_id in selected]
+
+    t_start = time.time()
+    result = aggregate_counts(
+        PG_ids,
+        counts_dir=None if args.counts_store != "" else args.output_counts,
+        store=args.counts_store if args.counts_store != "" else None,
+        workers=args.workers,
+        cache_dir=args.cache if args.cache != "" else None)
+
+    with open(args.output, "w", encoding="UTF-8") as f:
+        for w, c, d in result.most_common(args.top if args.top > 0 else None):
+            f.write("%s\t%d\t%d\n" % (w, c, d))
+
+    if not args.quiet:
+        if len(result.missing) > 0:
+            print("# WARNING: no counts for %d books, e.g. %s" % (
+                len(result.missing), ", ".join(result.missing[:5])))
+        print("%d books, %d tokens, %d types (%.1f s)" % (
+            len(result.PG_ids), result.L, result.V, time.time() - t_start))
@@ -0,0 +1,108 @@
+"""
+Benchmark the cleanup, tokenizer and pipeline on synthetic books.
+
+"""
+import argparse
+import glob
+import io
+import json
+import os
+import sys
+
+from src.benchmarks import BENCHMARKS, run_benchmarks, compare_results, check_markers
+from src.benchmarks import check_tokenizer, make_book
+from src.cleanup import strip_headers
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        "Time strip_headers, tokenize_text, filter_tokens, counting and"
+        " process_book on synthetic books (no network access needed).")
+    parser.add_argument(
+        "-s", "--sizes",
+        help="Comma-separated sizes of the books, in characters",
+        default="100000,1000000",
+        type=str)
+    parser.add_argument(
+        "-r", "--repeat",
+        help="Number of timings of each benchmark",
+        default=5,
+        type=int)
+    parser.add_argument(
+        "-b", "--benchmarks",
+        help="Comma-separated benchmarks to run (default: all), among "
+             + ", ".join(BENCHMARKS),
+        default="",
+        type=str)
+    parser.add_argument(
+        "--seed",
+        help="Seed of the synthetic books",
+        default=0,
+        type=int)
+    parser.add_argument(
+        "-o", "--output",
+        help="Path to save the results (json)",
+        default="",
+        type=str)
+    parser.add_argument(
+        "-c", "--compare",
+        help="Path to earlier results (json) to compare with",
+        default="",
+        type=str)
+    parser.add_argument(
+        "-k", "--check",
+        action="store_true",
+        help="First check that the compiled markers of strip_headers match"
+             " the plain loop over the markers, and that the fast tokenizer"
+             " gives the same tokens as the Treebank tokenizer")
+    parser.add_argument(
+        "-t", "--texts",
+        help="With --check, folder of text files (e.g. data_validation/text/)"
+             " on which to also check the fast tokenizer",
+        default="",
+        type=str)
+
+    args = parser.parse_args()
+
+    if args.check:
+        differ = check_markers(seed=args.seed)
+        for line, found, expected in differ[:10]:
+            print("# MISMATCH %r: %d instead of %d" % (line, found, expected))
+        if len(differ) > 0:
+            sys.exit(1)
+        print("markers: OK")
+
+        texts = [("synthetic", strip_headers(make_book(size, seed=args.seed)))
+                 for size in [int(s) for s in args.sizes.split(",")]]
+        if args.texts != "":
+            for path in sorted(glob.glob(os.path.join(args.texts, "PG*_text.txt"))):
+                with io.open(path, encoding="UTF-8") as f:
+                    texts.append((os.path.basename(path), f.read()))
+        n_differ = 0
+        for name, text in texts:
+            differ = check_tokenizer(text)
+            for sentence, tokens, expected in differ[:3]:
+                print("# MISMATCH in %s %r: %r instead of %r" % (name, sentence, tokens, expected))
+            n_differ += len(differ)
+        if n_differ > 0:
+            sys.exit(1)
+        print("tokenizer: OK (%d texts)" % len(texts))
+
+    results = run_benchmarks(
+        sizes=[int(s) for s in args.sizes.split(",")],
+        repeat=args.repeat,
+        seed=args.seed,
+        names=args.benchmarks.split(",") if args.benchmarks != "" else None,
+        verbose=True)
+
+    if args.output != "":
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+
+    if args.compare != "":
+        with open(args.compare) as f:
+            old = json.load(f)
+        print()
+        print("%-14s %10s %12s %12s %8s" % ("benchmark", "size", "before [ms]", "after [ms]", "speedup"))
+        for name, size, before, after, speedup in compare_results(old, results):
+            print("%-14s %10d %12.2f %12.2f %7.2fx" % (name, size, 1e3 * before, 1e3 * after, speedup))
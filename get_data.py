@@ -5,18 +5,25 @@ Written by
 M. Gerlach & F. Font-Clos
 
 """
-from src.utils import populate_raw_from_mirror, list_duplicates_in_mirror
+from src.utils import update_raw_from_mirror, list_duplicates_in_mirror
+from src.mirrorindex import load_mirror_index
+from src.manifest import update_changeset
 from src.metadataparser import make_df_metadata
 from src.bookshelves import get_bookshelves
-from src.bookshelves import parse_bookshelves
+from src.bookshelves import parse_bookshelves, save_bookshelves_index
+
+from src.shards import add_selection_arguments, selection_from_args, download_selection
 
 import argparse
 import os
-import subprocess
 import pickle
 
-if __name__ == '__main__':
 
+def get_parser(data_dir="data", ids="10000-10134"):
+    """
+    The arguments of get_data.py, with the data folders in data_dir and
+    the books of ids by default (see src.shards).
+    """
     parser = argparse.ArgumentParser(
         "Update local PG repository.\n\n"
         "This script will download all books currently not in your\n"
@@ -26,14 +33,14 @@ if __name__ == '__main__':
     parser.add_argument(
         "-m", "--mirror",
         help="Path to the mirror folder that will be updated via rsync.",
-        default='data/.mirror/',
+        default=f'{data_dir}/.mirror/',
         type=str)
 
     # raw dir
     parser.add_argument(
         "-r", "--raw",
         help="Path to the raw folder.",
-        default='data/raw/',
+        default=f'{data_dir}/raw/',
         type=str)
 
     # metadata dir
@@ -53,14 +60,51 @@ if __name__ == '__main__':
         action="store_true",
         help="Overwrite files in raw.")
 
+    parser.add_argument(
+        "-w", "--workers",
+        help="Number of threads linking the books into the raw folder.",
+        default=8,
+        type=int)
+
+    parser.add_argument(
+        "-mf", "--manifest",
+        help="Path to the manifest of the mirror and raw folders, used to "
+             "find the books that are new, changed or deleted.",
+        default=f'{data_dir}/mirror_manifest.json',
+        type=str)
+
+    parser.add_argument(
+        "-c", "--changeset",
+        help="Path where the new, changed and deleted books are saved (json), "
+             "for process_data.py --changeset. Books of a previous changeset "
+             "that process_data.py did not process yet are kept.",
+        default=f'{data_dir}/changeset.json',
+        type=str)
+
+    parser.add_argument(
+        "-bw", "--bookshelves_workers",
+        help="Number of processes parsing the bookshelves html files.",
+        default=os.cpu_count() or 1,
+        type=int)
+
+    parser.add_argument(
+        "-bi", "--bookshelves_index",
+        help="Path where the bookshelves of every book are saved (json, see "
+             "src.bookshelves.save_bookshelves_index), '' to skip.",
+        default='metadata/bookshelves_index.json',
+        type=str)
+
     parser.add_argument(
         "-q", "--quiet",
         action="store_true",
         help="Quiet mode, do not print info, warnings, etc"
         )
 
-    args = parser.parse_args()
+    add_selection_arguments(parser, ids=ids)
+    return parser
+
 
+def main(args):
     if not os.path.isdir(args.mirror):
         raise ValueError("The specified mirror directory does not exist.")
     if not os.path.isdir(args.raw):
@@ -68,42 +112,58 @@ if __name__ == '__main__':
     if not os.path.isdir(args.metadata):
         raise ValueError("The specified metadata directory does not exist.")
 
-    if args.quiet:
-        vstring = ""
-    else:
-        vstring = "v"
+    make_df_metadata(
+        path_xml=os.path.join(args.metadata, 'rdf-files.tar.bz2'),
+        path_out=os.path.join(args.metadata, 'metadata.csv'),
+        update=args.keep_rdf,
+        quiet=args.quiet
+        )
 
-    # Download books 10000-10135 (~100 books)
-    includes = []
-    for book_id in range(10000, 10135):
-        pattern = f"pg{book_id}[.-][t0][x.]t[x.]*[t8]"
-        includes.extend(["--include", pattern])
+    # download the selected books: the book files of the mirror are
+    # listed and selected locally, and only these are transferred
+    selection = selection_from_args(args)
+    if not args.quiet:
+        print(selection)
+    download_selection(selection, args.mirror, quiet=args.quiet)
 
-    sp_args = ["rsync", "-am%s" % vstring, "--delete-excluded",
-               "--include", "*/"] + includes + [
-               "--exclude", "*",
-               "aleph.gutenberg.org::gutenberg", args.mirror
-               ]
-    subprocess.call(sp_args)
+    # a single pass over the mirror (only the directories that changed
+    # since the last run are listed again), for the duplicates and raw
+    index = load_mirror_index(args.mirror)
+    if not args.quiet:
+        print("mirror: %d books, %d directories (%d listed, %d unchanged)" % (
+            len(index), len(index.dirs), index.listed, index.reused))
 
-    dups_list = list_duplicates_in_mirror(mirror_dir=args.mirror)
+    dups_list = list_duplicates_in_mirror(mirror_dir=args.mirror, index=index)
 
-    populate_raw_from_mirror(
+    # link the new and changed books into raw, and save what changed
+    changeset, populate_counts = update_raw_from_mirror(
         mirror_dir=args.mirror,
         raw_dir=args.raw,
+        manifest_path=args.manifest,
         overwrite=args.overwrite_raw,
         dups_list=dups_list,
-        quiet=args.quiet
+        quiet=args.quiet,
+        workers=args.workers,
+        index=index
         )
-
-    make_df_metadata(
-        path_xml=os.path.join(args.metadata, 'rdf-files.tar.bz2'),
-        path_out=os.path.join(args.metadata, 'metadata.csv'),
-        update=args.keep_rdf
-        )
-
-    BS_dict, BS_num_to_category_str_dict = parse_bookshelves()
+    # books of earlier runs that were not processed yet are kept
+    changeset = update_changeset(changeset, args.changeset)
+    if not args.quiet:
+        print("raw: %(linked)d linked, %(skipped)d already there, "
+              "%(duplicates)d duplicates, %(failed)d failed" % populate_counts)
+        print("changeset: %d new, %d changed, %d deleted books to process (%s)" % (
+            len(changeset["new"]), len(changeset["changed"]), len(changeset["deleted"]),
+            args.changeset))
+
+    BS_dict, BS_num_to_category_str_dict = parse_bookshelves(
+        workers=args.bookshelves_workers, quiet=args.quiet)
     with open("metadata/bookshelves_ebooks_dict.pkl", 'wb') as fp:
         pickle.dump(BS_dict, fp)
     with open("metadata/bookshelves_categories_dict.pkl", 'wb') as fp:
         pickle.dump(BS_num_to_category_str_dict, fp)
+    if args.bookshelves_index != "":
+        save_bookshelves_index(BS_dict, BS_num_to_category_str_dict, args.bookshelves_index)
+
+
+if __name__ == '__main__':
+    main(get_parser().parse_args())
@@ -9,13 +9,20 @@ import os
 from os.path import join
 import argparse
 import glob
-import ast
-import pandas as pd
 import traceback
+import time
 import nltk
 
-from src.pipeline import process_book
+from src.pipeline import log_line
+from src.tokenizer import tokenize_text, tokenize_text_fast
+from src.profiling import profile_line, summarize, format_report
+from src.parallel import process_books
+from src.scheduler import process_books_scheduled
+from src.manifest import load_manifest, save_manifest
+from src.countstore import CountStore
 from src.utils import get_langs_dict
+from src.metadataparser import read_metadata
+from src.shards import add_selection_arguments, selection_from_args
 
 # Ensure NLTK resources are downloaded
 try:
@@ -23,30 +30,34 @@ try:
 except LookupError:
     nltk.download('punkt_tab')
 
-if __name__ == '__main__':
 
+def get_parser(data_dir="data", ids="10000-10134"):
+    """
+    The arguments of process_data.py, with the data folders in data_dir and
+    the books of ids by default (see src.shards).
+    """
     parser = argparse.ArgumentParser(
         "Processing raw texts from Project Gutenberg:"
         " i) removing headers,ii) tokenizing, and iii) counting words.")
     parser.add_argument(
         "-r", "--raw",
         help="Path to the raw-folder",
-        default='data/raw/',
+        default=f'{data_dir}/raw/',
         type=str)
     parser.add_argument(
         "-ote", "--output_text",
         help="Path to text-output (text_dir)",
-        default='data/text/',
+        default=f'{data_dir}/text/',
         type=str)
     parser.add_argument(
         "-oto", "--output_tokens",
         help="Path to tokens-output (tokens_dir)",
-        default='data/tokens/',
+        default=f'{data_dir}/tokens/',
         type=str)
     parser.add_argument(
         "-oco", "--output_counts",
         help="Path to counts-output (counts_dir)",
-        default='data/counts/',
+        default=f'{data_dir}/counts/',
         type=str)
     parser.add_argument(
         "-p", "--pattern",
@@ -63,9 +74,82 @@ if __name__ == '__main__':
         help="Path to log file",
         default=".log",
         type=str)
+    parser.add_argument(
+        "-w", "--workers",
+        help="Number of worker processes (1 processes books serially)",
+        default=1,
+        type=int)
+    parser.add_argument(
+        "-pr", "--profile",
+        help="Path to a file where the time spent in each stage of every "
+             "book is appended (one line of json per book). A summary is "
+             "printed at the end",
+        default="",
+        type=str)
+    parser.add_argument(
+        "-t", "--timeout",
+        help="With --workers > 1, maximum time to process a book, in seconds "
+             "(0: no limit). Books that time out are reported and skipped",
+        default=0,
+        type=float)
+    parser.add_argument(
+        "-mm", "--max_memory",
+        help="With --workers > 1, maximum memory of each worker, in MB "
+             "(0: no limit)",
+        default=0,
+        type=int)
+    parser.add_argument(
+        "-hs", "--huge_size",
+        help="With --workers > 1, books whose raw file is larger than this, "
+             "in MB, are tokenized in chunks on all workers (0: never). "
+             "They are read and cleaned in the main process, where "
+             "--timeout and --max_memory do not apply",
+        default=50,
+        type=float)
+    parser.add_argument(
+        "-L", "--languages",
+        help="Comma-separated two-letter codes of the languages to process "
+             "(books in several languages are skipped)",
+        default="en",
+        type=str)
+    parser.add_argument(
+        "-ft", "--fast_tokenizer",
+        action="store_true",
+        help="Tokenize with src.tokenizer.tokenize_text_fast, which gives the "
+             "same tokens as the default tokenizer, faster"
+    )
+    parser.add_argument(
+        "-m", "--manifest",
+        help="Path to a manifest file. If given, only the stages whose "
+             "inputs changed since the last run are recomputed",
+        default="",
+        type=str)
+    parser.add_argument(
+        "-ch", "--changeset",
+        help="Path to a changeset saved by get_data.py. If given, only the "
+             "new and changed books are processed (the changed ones in full), "
+             "and the changeset is then emptied but for the books that failed",
+        default="",
+        type=str)
+    parser.add_argument(
+        "-tf", "--tokens_format",
+        help="Format of the tokens files: 'text' (one token per line) or "
+             "'binary' (arrays of vocabulary ids, see src.tokenstream)",
+        choices=["text", "binary"],
+        default="text",
+        type=str)
+    parser.add_argument(
+        "-cs", "--counts_store",
+        help="Path to a binary counts store (see src.countstore). If given, "
+             "the counts of every processed book are also added to it",
+        default="",
+        type=str)
 
-    args = parser.parse_args()
+    add_selection_arguments(parser, ids=ids)
+    return parser
 
+
+def main(args):
     if os.path.isdir(args.output_text) is False:
         raise ValueError(f"Text output directory '{args.output_text}' does not exist.")
     if os.path.isdir(args.output_tokens) is False:
@@ -73,11 +157,30 @@ if __name__ == '__main__':
     if os.path.isdir(args.output_counts) is False:
         raise ValueError(f"Counts output directory '{args.output_counts}' does not exist.")
 
-    metadata = pd.read_csv("metadata/metadata.csv").set_index("id")
+    metadata = read_metadata("metadata/metadata.csv").set_index("id")
     langs_dict = get_langs_dict()
+    languages = args.languages.split(",")
+    manifest = load_manifest(args.manifest) if args.manifest != "" else None
+    counts_store = CountStore(args.counts_store) if args.counts_store != "" else None
+    selection = selection_from_args(args)
 
-    pbooks = 0
-    for filename in glob.glob(join(args.raw, 'PG*_raw.txt')):
+    # select the books to process: all of raw, or those of the changeset
+    changed = set()
+    # books of the changeset to keep in it: not selected, or failed
+    remaining = set()
+    if args.changeset != "":
+        changeset = dict({"new": [], "changed": [], "deleted": []}, **load_manifest(args.changeset))
+        changed = set(changeset["changed"])
+        filenames = [join(args.raw, f"{PG_id}_raw.txt")
+                     for PG_id in changeset["new"] + changeset["changed"]]
+        if not args.quiet:
+            print("changeset: %d new, %d changed books" % (len(changeset["new"]), len(changed)))
+            for PG_id in changeset["deleted"]:
+                print(f"# WARNING: {PG_id} was deleted from the mirror")
+    else:
+        filenames = glob.glob(join(args.raw, 'PG*_raw.txt'))
+    jobs = []
+    for filename in filenames:
         try:
             file_basename = os.path.basename(filename)
             PG_id = file_basename.split("_")[0]
@@ -86,9 +189,9 @@ if __name__ == '__main__':
                 if not args.quiet:
                     print(f"# WARNING: Invalid ID '{PG_id}'. Skipping.")
                 continue
-            
-            pg_num = int(PG_id[2:])
-            if pg_num < 10000 or pg_num >= 10135:
+
+            if PG_id not in selection:
+                remaining.add(PG_id)
                 continue
 
             if PG_id not in metadata.index:
@@ -97,34 +200,105 @@ if __name__ == '__main__':
                 continue
 
             # Strict language filtering - MODIFIED SECTION
-            lang_list = ast.literal_eval(metadata.loc[PG_id, "language"])
-            if lang_list != ['en']:  # Changed condition
+            lang_list = metadata.loc[PG_id, "language"]
+            if len(lang_list) != 1 or lang_list[0] not in languages:
                 if not args.quiet:
-                    print(f"# WARNING: Non-English/multilingual book {PG_id} - Skipping.")
+                    print(f"# WARNING: Multilingual book or language not selected {PG_id} - Skipping.")
                 continue
 
             lang_id = lang_list[0]
             language = langs_dict.get(lang_id, "english")
 
-            process_book(
+            jobs.append(dict(
                 path_to_raw_file=filename,
                 text_dir=args.output_text,
                 tokens_dir=args.output_tokens,
                 counts_dir=args.output_counts,
                 language=language,
-                log_file=args.log_file
-            )
-            pbooks += 1
-            if not args.quiet:
-                print(f"Processed {pbooks} books...", end="\r")
-                
-        except UnicodeDecodeError:
-            if not args.quiet:
-                print(f"# WARNING: Encoding error in '{file_basename}'")
+                tokenize_f=tokenize_text_fast if args.fast_tokenizer else tokenize_text,
+                tokens_format=args.tokens_format,
+                overwrite_all=PG_id in changed,
+                profile=args.profile != "",
+                manifest_entry=None if manifest is None else manifest.get(PG_id, {})
+            ))
+
         except KeyError as e:
             if not args.quiet:
                 print(f"# WARNING: Metadata field missing for {PG_id} - {str(e)}")
         except Exception as e:
+            remaining.add(PG_id)
             if not args.quiet:
                 print(f"# ERROR: Failed to process '{file_basename}' - {str(e)}")
                 traceback.print_exc()
+
+    # process them; in parallel, each language goes to the workers that
+    # hold its tokenizer, largest books first (and the huge ones split
+    # over all workers)
+    if args.workers > 1:
+        results = process_books_scheduled(
+            jobs, workers=args.workers,
+            timeout=args.timeout if args.timeout > 0 else None,
+            max_memory=args.max_memory * 2**20 if args.max_memory > 0 else None,
+            huge_size=int(args.huge_size * 2**20) if args.huge_size > 0 else None)
+    else:
+        results = process_books(jobs)
+
+    pbooks = 0
+    profiles = []
+    t_start = time.time()
+    for job, stats, error in results:
+        file_basename = os.path.basename(job["path_to_raw_file"])
+        PG_id = file_basename.split("_")[0]
+        if error is None:
+            # a single process appends to the log, in the order books finish
+            if stats is not None and len(stats["stages"]) > 0 and args.log_file != "":
+                with open(args.log_file, "a") as f:
+                    f.write(log_line(stats))
+            if stats is not None and "profile" in stats and len(stats["stages"]) > 0:
+                profiles.append(dict(stats["profile"], PG=stats["PG"]))
+                with open(args.profile, "a") as f:
+                    f.write(profile_line(stats))
+            if counts_store is not None and stats is not None and \
+                ("tokens" in stats["stages"] or PG_id not in counts_store):
+                counts_store.add_counts_file(
+                    join(job["counts_dir"], f"{PG_id}_counts.txt"), PG_id=PG_id)
+            if manifest is not None:
+                manifest[PG_id] = {k: v for k, v in stats.items() if k not in ("PG", "stages", "profile")}
+                if pbooks % 1000 == 999:
+                    save_manifest(manifest, args.manifest)
+            pbooks += 1
+            if not args.quiet:
+                rate = pbooks / max(time.time() - t_start, 1e-9)
+                print(f"Processed {pbooks} books ({rate:.1f} books/s)...", end="\r")
+            continue
+
+        remaining.add(PG_id)
+        e, tb = error
+        if args.quiet:
+            continue
+        if isinstance(e, UnicodeDecodeError):
+            print(f"# WARNING: Encoding error in '{file_basename}'")
+        elif isinstance(e, KeyError):
+            print(f"# WARNING: Metadata field missing for {PG_id} - {str(e)}")
+        elif isinstance(e, (TimeoutError, MemoryError)):
+            print(f"# WARNING: '{file_basename}' is too large to process ({type(e).__name__})")
+        else:
+            print(f"# ERROR: Failed to process '{file_basename}' - {str(e)}")
+            print(tb, end="")
+
+    if manifest is not None:
+        save_manifest(manifest, args.manifest)
+
+    # the changeset is consumed, but for the books to try again
+    if args.changeset != "":
+        save_manifest({"new": [PG_id for PG_id in changeset["new"] if PG_id in remaining],
+                       "changed": [PG_id for PG_id in changeset["changed"] if PG_id in remaining],
+                       "deleted": []}, args.changeset)
+
+    if len(profiles) > 0 and not args.quiet:
+        print()
+        print(format_report(summarize(profiles)))
+
+
+if __name__ == '__main__':
+    main(get_parser().parse_args())
@@ -0,0 +1,34 @@
+"""
+Summarize the stage timings written by process_data.py --profile.
+
+"""
+import argparse
+import json
+
+from src.profiling import read_profiles, summarize, format_report
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        "Percentiles of the time spent in each stage of process_book, and the slowest books.")
+    parser.add_argument(
+        "profile",
+        help="Path to the file written with process_data.py --profile",
+        type=str)
+    parser.add_argument(
+        "-n", "--slowest",
+        help="Number of slowest books to list",
+        default=10,
+        type=int)
+    parser.add_argument(
+        "-j", "--json",
+        action="store_true",
+        help="Print the summary as json")
+
+    args = parser.parse_args()
+
+    summary = summarize(read_profiles(args.profile), n_slowest=args.slowest)
+    if args.json:
+        print(json.dumps(summary, indent=1))
+    else:
+        print(format_report(summary))
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+Corpus-wide counts of a selection of books.
+
+aggregate_counts sums the counts of a list of PG ids (e.g. from
+meta_query.get_ids()) and returns, for every word, its total count and
+its document frequency (the number of books it appears in).
+
+The counts are read either from a binary counts store (see
+src.countstore), where they are summed with a single numpy.bincount over
+the term ids of the books, or from the PG*_counts.txt files, which are
+parsed in chunks on a pool of processes.
+
+Results can be cached in a folder, under a hash of the selection and of
+the size and mtime of its counts files (or of its records in the store),
+so that asking again for the same books is a single file read.
+"""
+import hashlib
+import io
+import os
+
+import numpy as np
+
+from .countstore import CountStore
+from .parallel import parallel_map
+
+
+class CorpusCounts(object):
+    """
+    Summed counts of a selection of books.
+
+    Attributes
+    ----------
+    words : list of str
+        The vocabulary of the selection.
+    counts : numpy.ndarray
+        Total count of each word (int64).
+    doc_freq : numpy.ndarray
+        Number of books in which each word appears (int64).
+    PG_ids : list of str
+        The books that were summed.
+    missing : list of str
+        The selected books without counts.
+    """
+
+    def __init__(self, words, counts, doc_freq, PG_ids, missing=()):
+        self.words = list(words)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.doc_freq = np.asarray(doc_freq, dtype=np.int64)
+        self.PG_ids = list(PG_ids)
+        self.missing = list(missing)
+
+    @property
+    def V(self):
+        """Vocabulary size (number of types)."""
+        return len(self.words)
+
+    @property
+    def L(self):
+        """Number of tokens."""
+        return int(self.counts.sum())
+
+    def most_common(self, n=None):
+        """
+        (word, count, doc_freq) triples, the most frequent words first.
+        """
+        order = np.argsort(-self.counts, kind="stable")
+        if n is not None:
+            order = order[:n]
+        words = self.words
+        return [(words[i], int(self.counts[i]), int(self.doc_freq[i])) for i in order]
+
+    def to_frame(self):
+        """
+        pandas.DataFrame indexed by word, with columns counts and doc_freq,
+        the most frequent words first.
+        """
+        import pandas as pd
+        order = np.argsort(-self.counts, kind="stable")
+        return pd.DataFrame(
+            {"counts": self.counts[order], "doc_freq": self.doc_freq[order]},
+            index=pd.Index([self.words[i] for i in order], name="word"))
+
+    def save(self, path):
+        """
+        Save to a .npz file (see load).
+        """
+        np.savez(
+            path,
+            words=np.frombuffer("\n".join(self.words).encode("UTF-8"), dtype=np.uint8),
+            counts=self.counts, doc_freq=self.doc_freq,
+            PG_ids=np.array(self.PG_ids, dtype=str),
+            missing=np.array(self.missing, dtype=str))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load counts saved with save.
+        """
+        with np.load(path) as data:
+            words = data["words"].tobytes().decode("UTF-8")
+            words = words.split("\n") if len(data["counts"]) > 0 else []
+            return cls(words, data["counts"], data["doc_freq"],
+                       data["PG_ids"].tolist(), data["missing"].tolist())
+
+
+def _read_counts_files(paths):
+    """
+    Sum the counts files in paths; runs in the worker processes.
+
+    Returns the words, their counts and their document frequencies.
+    """
+    counts, doc_freq = {}, {}
+    for path in paths:
+        with io.open(path, encoding="UTF-8") as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) != 2:
+                    continue
+                w = fields[0]
+                counts[w] = counts.get(w, 0) + int(fields[1])
+                doc_freq[w] = doc_freq.get(w, 0) + 1
+    words = list(counts)
+    return (words,
+            np.fromiter(counts.values(), dtype=np.int64, count=len(words)),
+            np.fromiter((doc_freq[w] for w in words), dtype=np.int64, count=len(words)))
+
+
+def _from_counts_files(paths, workers=None, chunksize=100):
+    """
+    Sum counts files, chunksize files per job.
+    """
+    chunks = [paths[i:i + chunksize] for i in range(0, len(paths), chunksize)]
+    word_to_id = {}
+    ids, counts, doc_freq = [], [], []
+    for words, c, d in parallel_map(_read_counts_files, chunks, workers=workers):
+        ## ids of the words of the chunk in the merged vocabulary
+        chunk_ids = np.fromiter(
+            (word_to_id.setdefault(w, len(word_to_id)) for w in words),
+            dtype=np.int64, count=len(words))
+        ids.append(chunk_ids)
+        counts.append(c)
+        doc_freq.append(d)
+    ids = np.concatenate(ids + [np.zeros(0, dtype=np.int64)])
+    V = len(word_to_id)
+    return (list(word_to_id),
+            _sum_by_id(ids, np.concatenate(counts + [np.zeros(0, dtype=np.int64)]), V),
+            _sum_by_id(ids, np.concatenate(doc_freq + [np.zeros(0, dtype=np.int64)]), V))
+
+
+def _sum_by_id(ids, values, V):
+    """
+    Sum values with the same id; as numpy.bincount, but exact for int64.
+    """
+    total = np.zeros(V, dtype=np.int64)
+    if len(ids) > 0:
+        if int(values.sum()) < 2 ** 53:
+            total[:] = np.bincount(ids, weights=values, minlength=V)
+        else:
+            np.add.at(total, ids, values)
+    return total
+
+
+def _from_store(store, PG_ids):
+    """
+    Sum the counts of books in a counts store.
+    """
+    ids, values = store.get_many(PG_ids)
+    V = len(store.vocabulary)
+    total = _sum_by_id(ids, values.astype(np.int64), V)
+    doc_freq = np.bincount(ids, minlength=V).astype(np.int64)
+    ## only keep the words of the selection
+    used = np.flatnonzero(doc_freq > 0)
+    return store.vocabulary.decode(used), total[used], doc_freq[used]
+
+
+def aggregate_counts(PG_ids, counts_dir=None, store=None, workers=None, cache_dir=None):
+    """
+    Sum the counts of a selection of books.
+
+    Parameters
+    ----------
+    PG_ids : list of str
+        The books, e.g. ['PG10', 'PG11'] or meta_query.get_ids().
+    counts_dir : str
+        Folder with the PG*_counts.txt files.
+    store : str or CountStore
+        A counts store, used instead of counts_dir (faster).
+    workers : int
+        Number of processes reading counts files (defaults to the number
+        of CPUs). Not used with a store.
+    cache_dir : str
+        If given, results are saved in this folder and reused as long as
+        the selection and its counts did not change.
+
+    Returns
+    -------
+    CorpusCounts
+        Books without counts are listed in its missing attribute.
+    """
+    if (counts_dir is None) == (store is None):
+        raise ValueError("You must specify either counts_dir or store.")
+    PG_ids = list(dict.fromkeys(PG_ids))
+
+    # the books with counts, and what identifies the version of their counts
+    h = hashlib.sha1()
+    if store is not None:
+        if not isinstance(store, CountStore):
+            store = CountStore(store)
+        found = [PG_id for PG_id in PG_ids if PG_id in store]
+        h.update(("store\t%s\n" % os.path.abspath(store.path)).encode("UTF-8"))
+        for PG_id in found:
+            h.update(("%s\t%d\t%d\n" % ((PG_id,) + store.index[PG_id])).encode("UTF-8"))
+    else:
+        found, paths = [], []
+        h.update(("counts\t%s\n" % os.path.abspath(counts_dir)).encode("UTF-8"))
+        for PG_id in PG_ids:
+            path = os.path.join(counts_dir, "%s_counts.txt" % PG_id)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            found.append(PG_id)
+            paths.append(path)
+            h.update(("%s\t%d\t%d\n" % (PG_id, stat.st_size, stat.st_mtime_ns)).encode("UTF-8"))
+    found_set = set(found)
+    missing = [PG_id for PG_id in PG_ids if PG_id not in found_set]
+
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, "%s.npz" % h.hexdigest())
+        if os.path.isfile(cache_file):
+            return CorpusCounts.load(cache_file)
+
+    if store is not None:
+        words, counts, doc_freq = _from_store(store, found)
+    else:
+        words, counts, doc_freq = _from_counts_files(paths, workers=workers)
+    result = CorpusCounts(words, counts, doc_freq, found, missing)
+
+    if cache_file is not None:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # np.savez adds the .npz suffix
+        tmp_file = cache_file[:-len(".npz")] + ".tmp"
+        result.save(tmp_file)
+        os.replace(tmp_file + ".npz", cache_file)
+    return result
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the hot paths of the pipeline, on synthetic books.
+
+Books are generated offline from a fixed seed (see make_book), with a
+Gutenberg-style header and footer, a legalese block, paragraphs of
+sentences and a few very long lines, so that runs on different machines
+or commits time exactly the same input. The tokenizers are the ones
+bundled in src/nltk_data, so no network access is needed.
+
+Benchmarks:
+
+- strip_headers: cleanup of the raw book,
+- tokenize_text: sentence and word tokenization of the clean book,
+- tokenize_fast: the same with tokenize_text_fast, starting from an empty
+  cache of pieces every time,
+- filter_tokens: filtering of the Treebank tokens of the clean book,
+- counter: counting the filtered tokens, one sentence at a time,
+- process_book: the full pipeline from raw file to counts file.
+
+run_benchmarks returns the timings as a dict that can be saved as json,
+and compare_results compares two such results. check_markers checks the
+compiled marker matcher of src.cleanup against the plain loop over the
+markers, and check_tokenizer the fast tokenizer against the Treebank
+tokenizer.
+"""
+import datetime
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+from collections import Counter
+
+from . import cleanup
+from .cleanup import strip_headers, TEXT_START_MARKERS, TEXT_END_MARKERS
+from .tokenizer import tokenize_text, filter_tokens, get_sentence_tokenizer, get_word_tokenizer
+from .tokenizer import tokenize_text_fast, tokenize_sentence_fast, clear_piece_cache
+from .pipeline import process_book
+
+BENCHMARKS = ("strip_headers", "tokenize_text", "tokenize_fast", "filter_tokens", "counter",
+              "process_book")
+
+_WORDS = (
+    "the of and to a in that it was he his you with for had is as but be at "
+    "not by she on her which all have my this they from so were can't won't "
+    "Mr. Mrs. Dr. St. said upon into would could little great old never "
+    "before after again house father mother thought nothing something 1850 "
+    "3rd -- ; : , \"quoted\" 'single' (paren) café über naïve").split()
+
+
+def _sentence(rnd):
+    words = [rnd.choice(_WORDS) for _ in range(rnd.randint(3, 25))]
+    words[0] = words[0].capitalize()
+    return " ".join(words) + rnd.choice([".", ".", ".", "!", "?", ".\""])
+
+
+def _paragraph(rnd, width=72):
+    text = " ".join(_sentence(rnd) for _ in range(rnd.randint(1, 8)))
+    # wrap as in most Gutenberg files
+    lines, line = [], []
+    for word in text.split(" "):
+        if sum(len(w) + 1 for w in line) + len(word) > width:
+            lines.append(" ".join(line))
+            line = []
+        line.append(word)
+    lines.append(" ".join(line))
+    return lines
+
+
+def make_book(size, seed=0, long_lines=True, legalese=True):
+    """
+    Make a synthetic Gutenberg-style book.
+
+    Parameters
+    ----------
+    size : int
+        Approximate length of the body of the book, in characters.
+    seed : int
+        Seed of the random generator; the same seed gives the same book.
+    long_lines : bool
+        If True, some paragraphs are written as a single very long line.
+    legalese : bool
+        If True, a legalese block is inserted in the body.
+
+    Returns
+    -------
+    str
+        The raw text of the book.
+    """
+    rnd = random.Random(seed)
+    start_markers = sorted(TEXT_START_MARKERS)
+    end_markers = sorted(TEXT_END_MARKERS)
+    lines = [
+        "The Project Gutenberg EBook of A Synthetic Book, by Nobody",
+        "",
+        "This eBook is for the use of anyone anywhere at no cost and with",
+        "almost no restrictions whatsoever.",
+        "",
+        "Title: A Synthetic Book %d" % seed,
+        "Author: Nobody",
+        "Release Date: January 1, 2000 [EBook #%d]" % seed,
+        "Language: English",
+        "",
+        "*** START OF THIS PROJECT GUTENBERG EBOOK A SYNTHETIC BOOK ***",
+        "",
+        rnd.choice(start_markers) + " the volunteers.",
+        "",
+    ]
+    body, n = [], 0
+    legalese_at = size // 2 if legalese else -1
+    while n < size:
+        if 0 <= legalese_at <= n:
+            body += ["<<THIS ELECTRONIC VERSION OF THE BOOK IS PROVIDED AS IS>>"]
+            body += ["legal text %d" % i for i in range(20)]
+            body += ["SERVICE THAT CHARGES FOR DOWNLOAD TIME OR FOR MEMBERSHIP.>>", ""]
+            legalese_at = -1
+        if long_lines and rnd.random() < 0.02:
+            paragraph = [" ".join(" ".join(_paragraph(rnd)) for _ in range(20))]
+        else:
+            paragraph = _paragraph(rnd)
+        if rnd.random() < 0.05:
+            paragraph = ["CHAPTER %d" % len(body)]
+        body += paragraph + [""]
+        n += sum(len(line) + 1 for line in paragraph) + 1
+    lines += body
+    lines += ["End of the Project Gutenberg EBook of A Synthetic Book",
+              "",
+              rnd.choice(end_markers) + " A SYNTHETIC BOOK ***",
+              ""]
+    lines += ["license line %d: Project Gutenberg-tm electronic works" % i for i in range(300)]
+    return "\n".join(lines) + "\n"
+
+
+def _reference_marker_flags(line):
+    """
+    The flags of cleanup.marker_flags, one any(startswith) loop per set.
+    """
+    found = 0
+    for flag, markers in ((cleanup.TEXT_START, cleanup.TEXT_START_MARKERS),
+                          (cleanup.TEXT_END, cleanup.TEXT_END_MARKERS),
+                          (cleanup.LEGALESE_START, cleanup.LEGALESE_START_MARKERS),
+                          (cleanup.LEGALESE_END, cleanup.LEGALESE_END_MARKERS)):
+        if any(line.startswith(token) for token in markers):
+            found |= flag
+    return found
+
+
+def check_markers(seed=0):
+    """
+    Compare cleanup.marker_flags with the loop over all the markers, on
+    every marker, every prefix of a marker, markers followed or preceded
+    by text, and the lines of a synthetic book.
+
+    Returns the list of (line, flags, expected flags) that differ.
+    """
+    markers = sorted(cleanup.TEXT_START_MARKERS | cleanup.TEXT_END_MARKERS
+                     | cleanup.LEGALESE_START_MARKERS | cleanup.LEGALESE_END_MARKERS)
+    lines = ["", " ", "*", "***", "\ufeff*** START OF THIS PROJECT GUTENBERG"]
+    for m in markers:
+        lines += [m[:k] for k in range(len(m) + 1)]
+        lines += [m + " A BOOK ***", m + m, " " + m, m.lower(), m.upper()]
+        lines += [a + b for a in (m, m[:-1]) for b in markers[:5]]
+    lines += make_book(100000, seed=seed).splitlines()
+    differ = []
+    for line in lines:
+        found, expected = cleanup.marker_flags(line), _reference_marker_flags(line)
+        if found != expected:
+            differ.append((line, found, expected))
+    return differ
+
+
+def check_tokenizer(text, language="english"):
+    """
+    Compare tokenize_sentence_fast with the Treebank tokenizer and
+    filter_tokens, on every sentence of a text.
+
+    Returns the list of (sentence, tokens, expected tokens) that differ.
+    """
+    word_tokenizer = get_word_tokenizer()
+    differ = []
+    for start, end in get_sentence_tokenizer(language).span_tokenize(text):
+        sentence = text[start:end]
+        tokens = tokenize_sentence_fast(sentence)
+        expected = filter_tokens(word_tokenizer.tokenize(sentence))
+        if tokens != expected:
+            differ.append((sentence, tokens, expected))
+    return differ
+
+
+def time_function(f, repeat=5, number=1):
+    """
+    Time f() repeat times (each time running it number times).
+
+    Returns the min, median and mean time of a single call, in seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            f()
+        times.append((time.perf_counter() - t0) / number)
+    times.sort()
+    return {"min": times[0], "median": times[len(times) // 2],
+            "mean": sum(times) / len(times), "repeat": repeat, "number": number}
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _book_benchmarks(raw, tmp_dir):
+    """
+    The functions to time on a raw book, by benchmark name.
+    """
+    clean = strip_headers(raw)
+    sentence_tokenizer = get_sentence_tokenizer("english")
+    word_tokenizer = get_word_tokenizer()
+    sentences = [word_tokenizer.tokenize(clean[start:end])
+                 for start, end in sentence_tokenizer.span_tokenize(clean)]
+    filtered = [filter_tokens(tokens) for tokens in sentences]
+
+    raw_file = os.path.join(tmp_dir, "PG1_raw.txt")
+    with open(raw_file, "w", encoding="UTF-8") as f:
+        f.write(raw)
+    for d in ("text", "tokens", "counts"):
+        os.makedirs(os.path.join(tmp_dir, d), exist_ok=True)
+
+    def counter():
+        counts = Counter()
+        for tokens in filtered:
+            counts.update(tokens)
+        return counts
+
+    return {
+        "strip_headers": lambda: strip_headers(raw),
+        "tokenize_text": lambda: tokenize_text(clean),
+        "tokenize_fast": lambda: (clear_piece_cache(), tokenize_text_fast(clean)),
+        "filter_tokens": lambda: [filter_tokens(tokens) for tokens in sentences],
+        "counter": counter,
+        "process_book": lambda: process_book(
+            path_to_raw_file=raw_file,
+            text_dir=os.path.join(tmp_dir, "text"),
+            tokens_dir=os.path.join(tmp_dir, "tokens"),
+            counts_dir=os.path.join(tmp_dir, "counts"),
+            overwrite_all=True),
+    }
+
+
+def run_benchmarks(sizes=(100000, 1000000), repeat=5, seed=0, names=None, verbose=False):
+    """
+    Run the benchmarks on synthetic books of the given sizes.
+
+    Parameters
+    ----------
+    sizes : list of int
+        Sizes of the books (see make_book), in characters.
+    repeat : int
+        Number of timings of each benchmark; the min and median are kept.
+    seed : int
+        Seed of the books.
+    names : list of str
+        Benchmarks to run (default: all, see BENCHMARKS).
+
+    Returns
+    -------
+    dict
+        - meta: date, commit, python and platform of the run,
+        - results: one dict per benchmark and size, with the timings
+          (see time_function) and the throughput in MB of raw text per
+          second (from the median).
+    """
+    if names is None:
+        names = BENCHMARKS
+    # load the tokenizers before timing anything
+    get_sentence_tokenizer("english")
+    results = []
+    tmp_dir = tempfile.mkdtemp(prefix="spgc_benchmark_")
+    try:
+        for size in sizes:
+            raw = make_book(size, seed=seed)
+            benchmarks = _book_benchmarks(raw, tmp_dir)
+            for name in names:
+                timing = time_function(benchmarks[name], repeat=repeat)
+                result = dict(timing, name=name, size=size, chars=len(raw),
+                              mb_per_s=len(raw.encode("UTF-8")) / 2**20 / timing["median"])
+                results.append(result)
+                if verbose:
+                    print(format_result(result))
+    finally:
+        shutil.rmtree(tmp_dir)
+    return {
+        "meta": {
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "seed": seed,
+        },
+        "results": results,
+    }
+
+
+def format_result(result):
+    return "%-14s %10d chars %10.2f ms (min %.2f ms) %8.2f MB/s" % (
+        result["name"], result["chars"], 1e3 * result["median"],
+        1e3 * result["min"], result["mb_per_s"])
+
+
+def compare_results(old, new):
+    """
+    Compare two results of run_benchmarks.
+
+    Returns a list of (name, size, old median, new median, speedup) for
+    the benchmarks found in both.
+    """
+    old_results = dict(((r["name"], r["size"]), r) for r in old["results"])
+    comparison = []
+    for r in new["results"]:
+        key = (r["name"], r["size"])
+        if key in old_results:
+            before = old_results[key]["median"]
+            comparison.append((r["name"], r["size"], before, r["median"], before / r["median"]))
+    return comparison
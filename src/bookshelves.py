@@ -2,11 +2,15 @@
 """Functions to download, parse and filter Gutenberg's bookshelves."""
 
 import os
+import io
 import glob
+import json
 import numpy as np
 import pandas as pd
 import lxml.html
+from lxml import etree
 import subprocess
+from multiprocessing import Pool
 
 
 def get_bookshelves():
@@ -45,50 +49,146 @@ def get_bookshelves():
     subprocess.call(sp_args)
     return None
 
-def parse_bookshelves():
+class _BookshelfTarget(object):
+    """
+    lxml parser target collecting the links to ebooks and the titles of a
+    bookshelf page, as the tags are parsed (no tree is built).
+    """
+
+    def __init__(self):
+        self.PGids = []
+        self.titles = []
+        self._title = None
+
+    def start(self, tag, attrib):
+        if tag == "a":
+            link = attrib.get("href")
+            # links to ebooks that are not searches
+            if link is not None and link.find("ebooks") > -1 and link.find("search") == -1:
+                self.PGids.append("PG"+link.split("/")[-1])
+        elif tag == "title":
+            self._title = []
+
+    def end(self, tag):
+        if tag == "title" and self._title is not None:
+            # None for an empty title, as the .text of the element
+            self.titles.append("".join(self._title) if len(self._title) > 0 else None)
+            self._title = None
+
+    def data(self, data):
+        if self._title is not None:
+            self._title.append(data)
+
+    def close(self):
+        return self.PGids, self.titles
+
+
+def _parse_bookshelf(path, blocksize=1 << 16):
+    """
+    Links to ebooks and titles of a bookshelf html file.
+
+    The file is fed in blocks to lxml's html parser, which calls a
+    _BookshelfTarget for every tag instead of building the DOM of the page.
+
+    Returns
+    -------
+    list, list
+        The PG ids of the links (e.g. PG12345, in the order of the page)
+        and the texts of the <title> elements.
+    """
+    parser = etree.HTMLParser(target=_BookshelfTarget(), encoding="UTF-8")
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            parser.feed(block)
+    return parser.close()
+
+
+def parse_bookshelves(html_dir="metadata/bookshelves_html", workers=1, quiet=False):
     """
     Parse the bookshelves html files.
 
     Builds up a dictionary of bookshelf_category:list(book_ids) and 
     a dictionary of bookshelf_category:list(title_category)
     from the individual html files of each bs.
-    
-    Prints the errors.
+
+    Parameters
+    ----------
+    html_dir : str
+        Folder of the html files, one per bookshelf.
+    workers : int
+        Number of processes parsing the files.
+    quiet : bool
+        If False, prints the bookshelves without a title, or with several
+        titles (the first one is used).
     """
     # parse the data
-    BS_paths = glob.glob("metadata/bookshelves_html/*")
-    BS = [path.split("/")[-1] for path in BS_paths]
+    BS_paths = glob.glob(os.path.join(html_dir, "*"))
+    if workers > 1 and len(BS_paths) > 1:
+        with Pool(processes=workers) as pool:
+            parsed = pool.map(_parse_bookshelf, BS_paths,
+                              chunksize=max(1, len(BS_paths) // (4 * workers)))
+    else:
+        parsed = [_parse_bookshelf(path) for path in BS_paths]
 
     BS_dict = {}
     BS_num_to_category_str_dict = {}
-    for path in BS_paths:
+    for path, (PGids, title_categories) in zip(BS_paths, parsed):
         bs = path.split("/")[-1]
-        BS_dict[bs] = []
-        with open(path, "r", encoding="UTF-8") as foo:
-            dom = lxml.html.fromstring(foo.read())
-            # select the url in href for all a tags(links)
-            for link in dom.xpath('//a/@href'):
-                # links to ebooks that are not searches
-                if link.find("ebooks") > -1 and link.find("search") == -1:
-                    PGid = "PG"+link.split("/")[-1]
-                    BS_dict[bs].append(PGid)
-            # get title of the category
-            title_categories = dom.findall('.//title') # './/title' finds recursively the element with tag 'title'
-            # check if there is only one title in the metadata of the category
-            if len(title_categories) == 0:
-                # debug prints
-                print('No category title')
-                print(path, list(dom), dom.text_content())
-                title_category = None
-            elif len(title_categories) == 1:
-                title_category = title_categories[0].text
-            else:
-                # get only first title but check also others
-                title_category = title_categories[0].text
-                print([title_categories[i].text for i in range(len(title_categories))])
-            BS_num_to_category_str_dict[bs] = title_category
         # delete empty BSs
-        if len(BS_dict[bs]) == 0:
-            del BS_dict[bs]
-            del BS_num_to_category_str_dict[bs]
+        if len(PGids) == 0:
+            continue
+        BS_dict[bs] = PGids
+        # check if there is only one title in the metadata of the category
+        if len(title_categories) == 0:
+            if not quiet:
+                print("# WARNING: no category title in %s" % path)
+            title_category = None
+        else:
+            # get only first title but check also others
+            title_category = title_categories[0]
+            if len(title_categories) > 1 and not quiet:
+                print("# WARNING: %d category titles in %s: %s" % (
+                    len(title_categories), path, title_categories))
+        BS_num_to_category_str_dict[bs] = title_category
     return BS_dict, BS_num_to_category_str_dict
+
+
+def bookshelves_index(BS_dict):
+    """
+    Invert the dictionary of bookshelf_category:list(book_ids) of
+    parse_bookshelves into book_id:list(bookshelf_category).
+
+    Every bookshelf of a book is listed once, sorted.
+    """
+    index = {}
+    for bs, PGids in BS_dict.items():
+        for PGid in PGids:
+            index.setdefault(PGid, set()).add(bs)
+    return dict((PGid, sorted(index[PGid])) for PGid in sorted(index))
+
+
+def save_bookshelves_index(BS_dict, BS_num_to_category_str_dict, path):
+    """
+    Save the bookshelves of every book as json: {"books": book_id:
+    list(bookshelf_category), "categories": bookshelf_category:
+    title_category}.
+    """
+    with io.open(path, "w", encoding="UTF-8") as f:
+        json.dump({"books": bookshelves_index(BS_dict),
+                   "categories": BS_num_to_category_str_dict},
+                  f, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+
+def load_bookshelves_index(path):
+    """
+    Load the bookshelves index saved by save_bookshelves_index.
+
+    Returns
+    -------
+    dict, dict
+        book_id:list(bookshelf_category) and
+        bookshelf_category:title_category.
+    """
+    with io.open(path, encoding="UTF-8") as f:
+        index = json.load(f)
+    return index["books"], index["categories"]
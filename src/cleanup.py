@@ -4,6 +4,7 @@
 from __future__ import unicode_literals
 import os
 import io
+import re
 
 
 def cleanup(path, text_dir):
@@ -17,13 +18,13 @@ def cleanup(path, text_dir):
 
     """
     PG_number = path.split("/")[-1].split("_")[0][2:]
-    with io.open(path) as f:
-        text = f.read()
-
-    clean = strip_headers(text)
+    sep = str(os.linesep)
     source_file = os.path.join(text_dir, "PG%s_text.txt" % PG_number)
-    with io.open(source_file, "w") as f:
-        f.write(clean)
+    with io.open(path) as f_in, io.open(source_file, "w") as f_out:
+        for n, line in enumerate(iter_strip_headers(f_in)):
+            if n > 0:
+                f_out.write(sep)
+            f_out.write(line)
 
 
 ############
@@ -119,62 +120,177 @@ LEGALESE_START_MARKERS = frozenset(("<<THIS ELECTRONIC VERSION OF",))
 LEGALESE_END_MARKERS = frozenset(("SERVICE THAT CHARGES FOR DOWNLOAD",))
 
 
-def strip_headers(text):
+# Flags of the marker sets a line starts with (see marker_flags)
+TEXT_START = 1
+TEXT_END = 2
+LEGALESE_START = 4
+LEGALESE_END = 8
+
+
+def _compile_markers(marker_sets):
     """
-    Remove lines that are part of the Project Gutenberg header or footer.
+    Compile sets of markers into a single anchored regex.
 
-    Note: this function is a port of the C++ utility by Johannes Krugel. The
-    original version of the code can be found at:
-    http://www14.in.tum.de/spp1307/src/strip_headers.cpp
+    Parameters
+    ----------
+    marker_sets : list
+        (flag, markers) pairs.
+
+    Returns
+    -------
+    tuple
+        - k: the length of the prefixes (at most 4, at most the length of
+          the shortest marker),
+        - prefixes: the first k characters of every marker, so that most
+          lines are rejected without the regex,
+        - match: the match method of the regex; with the longest markers
+          first, it matches the longest marker the line starts with,
+        - flags: for every marker, the flags of all the sets holding one of
+          its prefixes, i.e. of all the markers the line starts with.
+    """
+    marker_flags = {}
+    for flag, markers in marker_sets:
+        for m in markers:
+            marker_flags[m] = marker_flags.get(m, 0) | flag
+    flags = {}
+    for m in marker_flags:
+        flags[m] = 0
+        for prefix, flag in marker_flags.items():
+            if m.startswith(prefix):
+                flags[m] |= flag
+    k = min(4, min(len(m) for m in marker_flags))
+    prefixes = frozenset(m[:k] for m in marker_flags)
+    pattern = "|".join(
+        re.escape(m) for m in sorted(marker_flags, key=len, reverse=True))
+    return k, prefixes, re.compile(pattern).match, flags
+
+
+_prefix_length, _marker_prefixes, _match_marker, _marker_flags = _compile_markers((
+    (TEXT_START, TEXT_START_MARKERS),
+    (TEXT_END, TEXT_END_MARKERS),
+    (LEGALESE_START, LEGALESE_START_MARKERS),
+    (LEGALESE_END, LEGALESE_END_MARKERS),
+))
+
+
+def marker_flags(line):
+    """
+    The marker sets the line starts with, as an OR of TEXT_START, TEXT_END,
+    LEGALESE_START and LEGALESE_END (0 if none).
+
+    The flag of a set is on if, and only if,
+    any(line.startswith(token) for token in markers).
+    """
+    if line[:_prefix_length] not in _marker_prefixes:
+        return 0
+    m = _match_marker(line)
+    return 0 if m is None else _marker_flags[m.group()]
+
+
+def iter_lines(f):
+    """
+    Iterate over the lines of a file without their line terminators.
+
+    Lines are split exactly like str.splitlines would split the whole
+    content of the file.
+    """
+    for chunk in f:
+        for line in chunk.splitlines():
+            yield line
+
+
+def iter_strip_headers(lines):
+    """
+    Streaming version of strip_headers.
+
+    Only the first lines of the text, where the end of the header may still
+    be found, are kept in memory. After that, lines are yielded as they are
+    read.
 
     Args:
-        text (unicode): The body of the text to clean up.
+        lines (iter): The lines of the text, without line terminators, or
+            a file handle opened in text mode.
 
-    Returns:
-        unicode: The text with any non-text content removed.
+    Yields:
+        unicode: The lines of the text with any non-text content removed.
 
     """
-    lines = text.splitlines()
+    if hasattr(lines, "read"):
+        lines = iter_lines(lines)
     sep = str(os.linesep)
 
     out = []
     i = 0
-    footer_found = False
     ignore_section = False
 
+    prefix_length, prefixes = _prefix_length, _marker_prefixes
+    match, flags = _match_marker, _marker_flags
+
     for line in lines:
-        reset = False
-
-        if i <= 600:
-            # Check if the header ends here
-            if any(line.startswith(token) for token in TEXT_START_MARKERS):
-                reset = True
-
-            # If it's the end of the header, delete the output produced so far.
-            # May be done several times, if multiple lines occur indicating the
-            # end of the header
-            if reset:
-                out = []
-                continue
+        # one lookup for all the markers; most lines stop at the prefix
+        if line[:prefix_length] in prefixes:
+            m = match(line)
+            found = 0 if m is None else flags[m.group()]
+        else:
+            found = 0
 
-        if i >= 100:
-            # Check if the footer begins here
-            if any(line.startswith(token) for token in TEXT_END_MARKERS):
-                footer_found = True
+        if found:
+            if i <= 600:
+                # Check if the header ends here. If so, delete the output
+                # produced so far. May be done several times, if multiple
+                # lines occur indicating the end of the header
+                if found & TEXT_START:
+                    out = []
+                    continue
 
-            # If it's the beginning of the footer, stop output
-            if footer_found:
-                break
+            if i >= 100:
+                # Check if the footer begins here. If so, stop output
+                if found & TEXT_END:
+                    break
 
-        if any(line.startswith(token) for token in LEGALESE_START_MARKERS):
-            ignore_section = True
-            continue
-        elif any(line.startswith(token) for token in LEGALESE_END_MARKERS):
-            ignore_section = False
-            continue
+            if found & LEGALESE_START:
+                ignore_section = True
+                continue
+            elif found & LEGALESE_END:
+                ignore_section = False
+                continue
 
         if not ignore_section:
-            out.append(line.rstrip(sep))
+            line = line.rstrip(sep)
             i += 1
+            if out is None:
+                yield line
+            else:
+                out.append(line)
+                # past the header window the output can no longer be reset
+                if i > 600:
+                    for buffered in out:
+                        yield buffered
+                    out = None
+
+    if out is not None:
+        for buffered in out:
+            yield buffered
+
+
+def strip_headers(text):
+    """
+    Remove lines that are part of the Project Gutenberg header or footer.
+
+    Note: this function is a port of the C++ utility by Johannes Krugel. The
+    original version of the code can be found at:
+    http://www14.in.tum.de/spp1307/src/strip_headers.cpp
+
+    Args:
+        text (unicode): The body of the text to clean up.
+
+    Returns:
+        unicode: The text with any non-text content removed.
+
+    """
+    return str(os.linesep).join(iter_strip_headers(text.splitlines()))
+
 
-    return sep.join(out)
+# Bump whenever a change to strip_headers (or to the markers) changes its
+# output, so that incremental runs know the text files must be recomputed.
+strip_headers.version = 1
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Binary store of the counts of all books.
+
+The store is a directory with
+
+- vocab.txt: the corpus-wide vocabulary (see src.vocabulary),
+- term_ids.i32: the term ids of all books, one after the other,
+- counts.u32: the corresponding counts,
+- index.tsv: one line 'PG-id<TAB>start<TAB>length' per book, giving the
+  position of the book in the two arrays.
+
+The arrays are raw native-endian int32 and uint32, so that they can be memory-mapped
+with numpy. Together, index, term ids and counts are a CSR sparse matrix
+of books x terms.
+
+Books are appended; if a book is added again, the last record is used.
+Only one process should write to a store at a time.
+"""
+import io
+import os
+
+import numpy as np
+
+from .vocabulary import Vocabulary
+
+try:
+    import scipy.sparse
+except ImportError:
+    scipy = None
+
+
+class CountStore(object):
+
+    def __init__(self, path):
+        '''path: directory of the store. It is created if it does not exist.
+        '''
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.vocabulary = Vocabulary(os.path.join(path, "vocab.txt"))
+        self._term_ids_file = os.path.join(path, "term_ids.i32")
+        self._counts_file = os.path.join(path, "counts.u32")
+        self._index_file = os.path.join(path, "index.tsv")
+
+        ## PG-id --> (start, length), in order of insertion
+        self.index = {}
+        self._end = 0
+        if os.path.isfile(self._index_file):
+            with io.open(self._index_file, encoding="UTF-8") as f:
+                for line in f:
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) != 3:
+                        # partially written last line
+                        break
+                    PG_id, start, length = fields[0], int(fields[1]), int(fields[2])
+                    self.index.pop(PG_id, None)
+                    self.index[PG_id] = (start, length)
+                    self._end = max(self._end, start + length)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, PG_id):
+        return PG_id in self.index
+
+    def add(self, PG_id, counts):
+        '''Add the counts of a book.
+
+        counts: a dict (e.g. a Counter) word --> count, or a list of
+        (word, count) pairs.
+        '''
+        if isinstance(counts, dict):
+            counts = list(counts.items())
+        words = [w for w, c in counts]
+        term_ids = self.vocabulary.lookup(words).astype(np.int32)
+        values = np.array([c for w, c in counts], dtype=np.uint32)
+        # sorted by term id, as the rows of a canonical CSR matrix
+        order = np.argsort(term_ids, kind="stable")
+        term_ids, values = term_ids[order], values[order]
+
+        # drop anything written after the last complete record
+        for path, array in ((self._term_ids_file, term_ids), (self._counts_file, values)):
+            with io.open(path, "ab") as f:
+                f.truncate(self._end * 4)
+                f.write(array.tobytes())
+
+        start, length = self._end, len(words)
+        with io.open(self._index_file, "a", encoding="UTF-8") as f:
+            f.write("%s\t%d\t%d\n" % (PG_id, start, length))
+        self.index.pop(PG_id, None)
+        self.index[PG_id] = (start, length)
+        self._end = start + length
+
+    def add_counts_file(self, path, PG_id=None):
+        '''Add the counts of a book from its PG*_counts.txt file.
+        '''
+        if PG_id is None:
+            PG_id = os.path.basename(path).split("_")[0]
+        counts = []
+        with io.open(path, encoding="UTF-8") as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) == 2:
+                    counts.append((fields[0], int(fields[1])))
+        self.add(PG_id, counts)
+
+    def _arrays(self):
+        '''Memory-mapped term ids and counts of all records.
+        '''
+        if self._end == 0:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.uint32)
+        term_ids = np.memmap(self._term_ids_file, dtype=np.int32, mode="r", shape=(self._end,))
+        counts = np.memmap(self._counts_file, dtype=np.uint32, mode="r", shape=(self._end,))
+        return term_ids, counts
+
+    def get(self, PG_id):
+        '''Term ids (int32) and counts (uint32) of a book.
+        '''
+        start, length = self.index[PG_id]
+        term_ids, counts = self._arrays()
+        return term_ids[start:start + length], counts[start:start + length]
+
+    def get_many(self, PG_ids):
+        '''Term ids (int32) and counts (uint32) of several books, one after
+        the other.
+        '''
+        term_ids, counts = self._arrays()
+        spans = [self.index[PG_id] for PG_id in PG_ids]
+        return (np.concatenate([term_ids[s:s + l] for s, l in spans] + [np.zeros(0, dtype=np.int32)]),
+                np.concatenate([counts[s:s + l] for s, l in spans] + [np.zeros(0, dtype=np.uint32)]))
+
+    def get_counts(self, PG_id):
+        '''Counts of a book as a dict word --> count.
+        '''
+        term_ids, counts = self.get(PG_id)
+        return dict(zip(self.vocabulary.decode(term_ids), counts.tolist()))
+
+    def load_matrix(self, PG_ids=None):
+        '''Sparse matrix of counts, books x terms.
+
+        PG_ids: list of the books to load (rows of the matrix, in this
+        order). If None, all books in the store.
+
+        Returns the scipy.sparse.csr_matrix and the list of PG ids.
+        If the store holds exactly the selected books, in order and without
+        superseded records, the matrix is built on the memory-mapped arrays
+        without copying them, provided its rows are in canonical format
+        (term ids sorted and unique, as written by add): scipy sorts or
+        sums the rows of other matrices in place, which a read-only
+        memory map does not allow, so they are copied.
+        '''
+        if scipy is None:
+            raise ImportError("CountStore.load_matrix requires scipy.")
+        if PG_ids is None:
+            PG_ids = list(self.index)
+        PG_ids = list(PG_ids)
+        spans = np.array([self.index[PG_id] for PG_id in PG_ids], dtype=np.int64).reshape(-1, 2)
+        starts, lengths = spans[:, 0], spans[:, 1]
+        indptr = np.zeros(len(PG_ids) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+
+        term_ids, counts = self._arrays()
+        if indptr[-1] == self._end and np.array_equal(starts, indptr[:-1]):
+            indices, data = term_ids, counts
+        else:
+            indices = np.concatenate([term_ids[s:s + l] for s, l in spans] + [np.zeros(0, dtype=np.int32)])
+            data = np.concatenate([counts[s:s + l] for s, l in spans] + [np.zeros(0, dtype=np.uint32)])
+        matrix = scipy.sparse.csr_matrix(
+            (data, indices, indptr), shape=(len(PG_ids), len(self.vocabulary)), copy=False)
+        # checked without writing; e.g. stores written before add sorted
+        # the term ids of a book
+        if isinstance(indices, np.memmap) and not matrix.has_canonical_format:
+            matrix = scipy.sparse.csr_matrix(
+                (np.array(data), np.array(indices), indptr), shape=matrix.shape)
+        return matrix, PG_ids
+
+
+def build_count_store(counts_dir, path, overwrite=False):
+    '''Add all PG*_counts.txt files in counts_dir to the store in path.
+
+    Books already in the store are skipped, unless overwrite is True.
+    Returns the store.
+    '''
+    store = CountStore(path)
+    for filename in sorted(os.listdir(counts_dir)):
+        if not (filename.startswith("PG") and filename.endswith("_counts.txt")):
+            continue
+        PG_id = filename.split("_")[0]
+        if overwrite or PG_id not in store:
+            store.add_counts_file(os.path.join(counts_dir, filename), PG_id=PG_id)
+    return store
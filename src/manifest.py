@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Manifest of processed books, used to rebuild only what changed.
+
+The manifest is a dict, saved as json, mapping PG ids to the record
+returned by process_book: hash, size and mtime of the raw file, hash of
+the text file, versions of the cleanup and tokenize functions, language
+and the statistics of the book.
+
+get_data.py keeps another manifest, of the files of the mirror and raw
+directories (see file_records), and diffs it after every rsync to find the
+books that are new, changed or deleted (see diff_records), which
+process_data.py can take as its work list. Until process_data.py has
+processed them, the books of later runs are merged into the same
+changeset (see update_changeset).
+"""
+import hashlib
+import io
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+
+def load_manifest(path):
+    """
+    Load a manifest from a json file.
+
+    Returns an empty manifest if the file does not exist.
+    """
+    if not os.path.isfile(path):
+        return {}
+    with io.open(path, encoding="UTF-8") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, path):
+    """
+    Save a manifest as a json file.
+
+    The file is written under a temporary name and then renamed, so that an
+    interrupted run never leaves a truncated manifest behind.
+    """
+    tmp_path = path + ".tmp"
+    with io.open(tmp_path, "w", encoding="UTF-8") as f:
+        json.dump(manifest, f, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def file_digest(path, blocksize=1 << 20):
+    """
+    SHA-1 hex digest of the content of a file.
+    """
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def function_version(f):
+    """
+    Identify a processing function and the version of its output.
+
+    The version is taken from the function's 'version' attribute, which
+    must be bumped whenever a change to the function changes its output.
+    Functions without it are only identified by name.
+    """
+    return "%s.%s:%s" % (
+        f.__module__, f.__qualname__, getattr(f, "version", None))
+
+
+def file_records(paths, previous=None, workers=1):
+    """
+    Records of files: path, size, mtime (in ns), inode and SHA-1 digest.
+
+    Parameters
+    ----------
+    paths : dict
+        PG id --> path of the file.
+    previous : list of dict
+        Records of an earlier run (values of file_records). The digest of
+        a file is only computed if no record has the same inode, size and
+        mtime, so unchanged files, and the links in raw/ to files of the
+        mirror, are only stat-ed.
+    workers : int
+        Number of threads computing the digests.
+
+    Returns
+    -------
+    dict
+        PG id --> record. Files that cannot be read are left out.
+    """
+    known = {}
+    for records in previous if previous is not None else []:
+        for record in records.values():
+            known[(record["inode"], record["size"], record["mtime"])] = record["sha1"]
+
+    records, to_hash = {}, []
+    for PG_id, path in paths.items():
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        record = {"path": path, "size": st.st_size, "mtime": st.st_mtime_ns,
+                  "inode": st.st_ino, "sha1": None}
+        record["sha1"] = known.get((record["inode"], record["size"], record["mtime"]))
+        if record["sha1"] is None:
+            to_hash.append(PG_id)
+        records[PG_id] = record
+
+    def digest(PG_id):
+        try:
+            return file_digest(records[PG_id]["path"])
+        except OSError:
+            return None
+
+    if workers > 1 and len(to_hash) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            digests = list(executor.map(digest, to_hash))
+    else:
+        digests = [digest(PG_id) for PG_id in to_hash]
+    for PG_id, sha1 in zip(to_hash, digests):
+        if sha1 is None:
+            del records[PG_id]
+        else:
+            records[PG_id]["sha1"] = sha1
+    return records
+
+
+def diff_records(old, new):
+    """
+    Compare two results of file_records.
+
+    Returns
+    -------
+    dict
+        new, changed (different content) and deleted PG ids, sorted.
+    """
+    return {
+        "new": sorted(PG_id for PG_id in new if PG_id not in old),
+        "changed": sorted(PG_id for PG_id in new
+                          if PG_id in old and new[PG_id]["sha1"] != old[PG_id]["sha1"]),
+        "deleted": sorted(PG_id for PG_id in old if PG_id not in new),
+    }
+
+
+def merge_changesets(old, new):
+    """
+    Merge a changeset (see diff_records) into an earlier one whose books
+    were not processed yet.
+
+    A book is new if it is new in either and not deleted since, changed if
+    it changed in either and is not new, and deleted if it was deleted and
+    did not come back.
+    """
+    old_new, old_changed, old_deleted = [set(old.get(k, [])) for k in ("new", "changed", "deleted")]
+    new_new, new_changed, new_deleted = [set(new.get(k, [])) for k in ("new", "changed", "deleted")]
+    merged_new = (old_new | new_new) - new_deleted
+    return {
+        "new": sorted(merged_new),
+        "changed": sorted((old_changed | new_changed) - merged_new - new_deleted),
+        "deleted": sorted((old_deleted - new_new - new_changed) | new_deleted),
+    }
+
+
+def update_changeset(changeset, path):
+    """
+    Merge changeset into the one saved in path, if any (books that
+    process_data.py --changeset did not process yet), and save it.
+
+    Returns the merged changeset.
+    """
+    merged = merge_changesets(load_manifest(path), changeset)
+    save_manifest(merged, path)
+    return merged
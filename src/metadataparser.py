@@ -5,9 +5,12 @@ Extract metadata from Project Gutenberg RDF catalog into a Python dict.
 Based on https://bitbucket.org/c-w/gutenberg/
 """
 
+import ast
+import io
 import os
 import re
 import tarfile
+from collections import deque
 import urllib
 import urllib.request
 import pandas as pd
@@ -42,7 +45,11 @@ ETEXTRE = re.compile(r'''
 
 def make_df_metadata(path_xml='../metadata/rdf-files.tar.bz2',
                      path_out='../metadata/metadata.csv',
-                     update=False):
+                     update=False,
+                     workers=None,
+                     quiet=False,
+                     path_cache=None,
+                     path_store=None):
     """
     Write metadata in a csv.
 
@@ -59,6 +66,20 @@ def make_df_metadata(path_xml='../metadata/rdf-files.tar.bz2',
     update : bool
         (False) Download the latest rdf-file even if it already
         exists in path_xml
+    workers : int
+        Number of processes parsing the rdf-files (defaults to the
+        number of CPUs).
+    quiet : bool
+        If False, report the rdf-files that could not be parsed.
+    path_cache : str
+        Where to keep the parsed records of the rdf-files between runs
+        (defaults to path_out with a '_rdfcache.pkl' suffix instead of
+        '.csv'). Files whose name, mtime and size in the archive did not
+        change are not parsed again. Set to '' to disable the cache.
+    path_store : str
+        Where to save the typed metadata (see read_metadata). Defaults to
+        path_out with a '.pkl' suffix instead of '.csv'. Set to '' to only
+        write the csv-file.
 
 
     Notes
@@ -67,10 +88,28 @@ def make_df_metadata(path_xml='../metadata/rdf-files.tar.bz2',
 
 
     """
+    if path_cache is None:
+        path_cache = os.path.splitext(path_out)[0] + '_rdfcache.pkl'
+    if path_store is None:
+        path_store = os.path.splitext(path_out)[0] + '.pkl'
+    cache = None
+    if path_cache != '':
+        cache = {}
+        if os.path.isfile(path_cache):
+            with open(path_cache, 'rb') as f:
+                cache = pickle.load(f)
     # parse the xml-file
-    md = readmetadata(path_xml, update=update)
-    # convert into a pandas dataframe
-    df = pd.DataFrame.from_dict(md).T
+    df, failures = readmetadata_frame(path_xml, update=update, workers=workers,
+                                      cache=cache)
+    if cache is not None:
+        with open(path_cache + '.tmp', 'wb') as f:
+            pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path_cache + '.tmp', path_cache)
+    if len(failures) > 0 and not quiet:
+        print("# WARNING: %d RDF files could not be parsed" % len(failures))
+        for name, error in failures[:10]:
+            print("#   %s: %s" % (name, error))
+    typed = typed_metadata(df) if path_store != '' else None
     # which fields to keep
     columns_select = ['id', 'title', 'author', 'authoryearofbirth',
                       'authoryearofdeath', 'language', 'downloads',
@@ -82,10 +121,89 @@ def make_df_metadata(path_xml='../metadata/rdf-files.tar.bz2',
     # id as index
     df = df.set_index('id')
     df.to_csv(path_out)
+    if typed is not None:
+        # written after the csv-file, with its size and mtime, so that
+        # read_metadata knows the store matches it
+        st = os.stat(path_out)
+        typed.attrs['csv'] = [st.st_size, st.st_mtime_ns]
+        typed.to_pickle(path_store + '.tmp')
+        os.replace(path_store + '.tmp', path_store)
     return None
 
 
-def readmetadata(RDFFILES, update=False):
+def typed_metadata(df):
+    """
+    Convert the metadata to compact, typed columns.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Metadata as returned by readmetadata_frame (python objects).
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per book with columns
+        - id (str): 'PG' + Gutenberg identifier
+        - title, author (str)
+        - authoryearofbirth, authoryearofdeath, downloads (float, NaN if
+          missing)
+        - language, subjects, LCC (list of str, sorted for subjects and
+          LCC, empty if missing; no LCC column if df has none, as for
+          the csv-file)
+        - type (categorical)
+
+    """
+    def as_list(values, sort=False):
+        return [(sorted(v) if sort else list(v)) if isinstance(v, (list, set, tuple)) else []
+                for v in values]
+
+    columns = {
+        'id': ['PG%s' % x for x in df['id']],
+        'title': df['title'].to_numpy(),
+        'author': df['author'].to_numpy(),
+        'authoryearofbirth': pd.to_numeric(df['authoryearofbirth']).astype(float).to_numpy(),
+        'authoryearofdeath': pd.to_numeric(df['authoryearofdeath']).astype(float).to_numpy(),
+        'language': as_list(df['language']),
+        'downloads': pd.to_numeric(df['downloads']).astype(float).to_numpy(),
+        'subjects': as_list(df['subjects'], sort=True),
+    }
+    if 'LCC' in df:
+        columns['LCC'] = as_list(df['LCC'], sort=True)
+    columns['type'] = pd.Categorical(df['type'])
+    return pd.DataFrame(columns)
+
+
+def read_metadata(path='../metadata/metadata.csv'):
+    """
+    Load the metadata with typed columns (see typed_metadata).
+
+    Parameters
+    ----------
+    path : str
+        Either the typed metadata (.pkl) or the csv-file written by
+        make_df_metadata. For a csv-file, the typed metadata next to it
+        is used if it was written with this csv-file (same size and
+        mtime); otherwise the csv-file is parsed (slower, and without the
+        LCC column).
+
+    """
+    if path.endswith('.pkl'):
+        return pd.read_pickle(path)
+    path_store = os.path.splitext(path)[0] + '.pkl'
+    if os.path.isfile(path_store):
+        st = os.stat(path)
+        typed = pd.read_pickle(path_store)
+        if list(typed.attrs.get('csv', [])) == [st.st_size, st.st_mtime_ns]:
+            return typed
+    df = pd.read_csv(path)
+    df['id'] = df['id'].str[2:]
+    for field in ('language', 'subjects'):
+        df[field] = [ast.literal_eval(x) if isinstance(x, str) else None for x in df[field]]
+    return typed_metadata(df)
+
+
+def readmetadata(RDFFILES, update=False, workers=None):
     """
     Read/create cached metadata dump of Gutenberg catalog.
 
@@ -111,30 +229,55 @@ def readmetadata(RDFFILES, update=False):
     http://www.gutenberg.org/wiki/Gutenberg:Help_on_Bibliographic_Record_Page
 
     """
-    # if os.path.exists(PICKLEFILE):
-    #     metadata = pickle.load(gzip.open(PICKLEFILE, 'rb'))
-    # else:
     metadata = {}
-    for xml in getrdfdata(RDFFILES, update=update):
-        ebook = xml.find(r'{%(pg)s}ebook' % NS)
-        if ebook is None:
-            continue
-        result = parsemetadata(ebook)
+    for name, result, error in iterparsedrdf(RDFFILES, update=update, workers=workers):
         if result is not None:
             metadata[result['id']] = result
-        # pickle.dump(metadata, gzip.open(PICKLEFILE, 'wb'), protocol=-1)
     return metadata
 
 
-def getrdfdata(RDFFILES, update=False):
+def readmetadata_frame(RDFFILES, update=False, workers=None, cache=None):
     """
-    Download Project Gutenberg RDF catalog.
+    Read the metadata of the Gutenberg catalog into a DataFrame.
 
-    Yields
-    ------
-    xml.etree.ElementTree.Element
-        An etext meta-data definition.
+    Same content as readmetadata, one row per ebook and one column per
+    field of META_FIELDS, but the rows are collected column by column as
+    the RDF files are parsed. See iterparsedrdf for the cache.
+
+    Returns
+    --------
+    df : pandas.DataFrame
+        The metadata, with object columns (values as in readmetadata).
+    failures : list of (str, str)
+        Name and error message of the RDF files that could not be parsed.
 
+    """
+    columns = {field: [] for field in META_FIELDS}
+    rows = {}  # ebook id --> row number
+    failures = []
+    for name, result, error in iterparsedrdf(RDFFILES, update=update, workers=workers,
+                                             cache=cache):
+        if error is not None:
+            failures.append((name, error))
+        if result is None:
+            continue
+        row = rows.get(result['id'])
+        if row is None:
+            rows[result['id']] = len(rows)
+            for field in META_FIELDS:
+                columns[field].append(result[field])
+        else:
+            # a later record of the same ebook replaces the earlier one
+            for field in META_FIELDS:
+                columns[field][row] = result[field]
+    df = pd.DataFrame(
+        {field: pd.Series(columns[field], dtype=object) for field in META_FIELDS})
+    return df, failures
+
+
+def downloadrdf(RDFFILES, update=False):
+    """
+    Download Project Gutenberg RDF catalog, if needed.
     """
     if (not os.path.exists(RDFFILES)) or (update is True):
         # standard location of rdf files
@@ -146,6 +289,19 @@ def getrdfdata(RDFFILES, update=False):
             RDFURL = "http://gutenberg.readingroo.ms/cache/generated/feeds/rdf-files.tar.bz2"
             _, _ = urllib.request.urlretrieve(RDFURL, RDFFILES)
 
+
+def getrdfdata(RDFFILES, update=False):
+    """
+    Download Project Gutenberg RDF catalog.
+
+    Yields
+    ------
+    xml.etree.ElementTree.Element
+        An etext meta-data definition.
+
+    """
+    downloadrdf(RDFFILES, update=update)
+
     with tarfile.open(RDFFILES) as archive:
         for tarinfo in archive:
             try:
@@ -154,6 +310,134 @@ def getrdfdata(RDFFILES, update=False):
                 pass
 
 
+def iterrdfmembers(RDFFILES, batchsize=64, cache=None):
+    """
+    Read the RDF files in the catalog, in batches.
+
+    Files that are in cache with the same mtime and size are not extracted,
+    their content is None.
+
+    Yields
+    ------
+    list of (str, int, int, bytes)
+        Name, mtime, size and content of consecutive RDF files
+        (directories are skipped).
+
+    """
+    batch = []
+    with tarfile.open(RDFFILES) as archive:
+        for tarinfo in archive:
+            if not tarinfo.isfile():
+                continue
+            cached = cache.get(tarinfo.name) if cache is not None else None
+            if cached is not None and cached[:2] == (tarinfo.mtime, tarinfo.size):
+                data = None
+            else:
+                data = archive.extractfile(tarinfo).read()
+            batch.append((tarinfo.name, tarinfo.mtime, tarinfo.size, data))
+            if len(batch) >= batchsize:
+                yield batch
+                batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def parserdf(data):
+    """
+    Parse the content of an RDF file.
+
+    The file is parsed incrementally, and only up to the end of the
+    ebook definition.
+
+    Returns
+    -------
+    dict or None
+        The fields of the ebook (see parsemetadata), or None if the file
+        does not define an ebook.
+
+    """
+    ebook_tag = '{%(pg)s}ebook' % NS
+    depth = 0
+    for event, elem in ElementTree.iterparse(io.BytesIO(data), events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        # the ebook definition is a child of the root element
+        if depth == 1 and elem.tag == ebook_tag:
+            return parsemetadata(elem)
+    return None
+
+
+def _parserdfbatch(batch):
+    """
+    Parse a batch of RDF files (this runs in the worker processes).
+
+    Returns a list of (name, result, error) with the result of parserdf, or
+    the error message if the file could not be parsed. Files without
+    content (i.e. found in the cache) are left out.
+    """
+    out = []
+    for name, mtime, size, data in batch:
+        if data is None:
+            continue
+        try:
+            out.append((name, parserdf(data), None))
+        except Exception as e:
+            out.append((name, None, "%s: %s" % (type(e).__name__, e)))
+    return out
+
+
+def iterparsedrdf(RDFFILES, update=False, workers=None, cache=None):
+    """
+    Parse all the RDF files in the catalog, on a pool of processes.
+
+    The archive is read sequentially and its files are parsed in parallel.
+
+    Parameters
+    ----------
+    cache : dict
+        Records of a previous run, name --> (mtime, size, result, error).
+        Files with the same name, mtime and size are not parsed again, and
+        the cache is updated in place with the files of this archive.
+
+    Yields
+    ------
+    (str, dict, str)
+        Name of the RDF file, its fields (or None if the file does not
+        define an ebook or could not be parsed) and the error message
+        (or None), in the order of the archive.
+
+    """
+    # imported here, as src.parallel pulls in the whole processing pipeline
+    from .parallel import parallel_map
+
+    downloadrdf(RDFFILES, update=update)
+
+    # the batches handed to the workers, in order, with the files' metadata
+    batches = deque()
+    def members():
+        for batch in iterrdfmembers(RDFFILES, cache=cache):
+            batches.append(batch)
+            yield batch
+
+    new_cache = {}
+    for results in parallel_map(_parserdfbatch, members(), workers=workers):
+        batch = batches.popleft()
+        parsed = {name: (result, error) for name, result, error in results}
+        for name, mtime, size, data in batch:
+            if data is None:
+                result, error = cache[name][2:]
+            else:
+                result, error = parsed[name]
+            new_cache[name] = (mtime, size, result, error)
+            yield name, result, error
+
+    if cache is not None:
+        cache.clear()
+        cache.update(new_cache)
+
+
 def parsemetadata(ebook):
     """
     Parse an etext meta-data definition to extract fields.
@@ -278,4 +562,4 @@ def safeunicode(arg, *args, **kwargs):
     return arg if isinstance(arg, str) else unicode(arg, *args, **kwargs)
 
 
-__all__ = ['readmetadata']
+__all__ = ['readmetadata', 'readmetadata_frame', 'read_metadata']
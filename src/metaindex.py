@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""
+Inverted indexes over the metadata, used by meta_query to answer filters
+without scanning the columns.
+
+All indexes refer to books by their position (row number) in the typed
+metadata (see metadataparser.read_metadata). Every selection takes an
+array of positions and returns the ones that match, in the same order,
+so that its cost depends on the books still selected rather than on the
+size of the catalog. The *_count methods estimate how many books a
+selection keeps, which is used to run the most selective filters first.
+
+- language, subjects, LCC: value --> sorted positions of the books with
+  this value, and of the books with only this value.
+- author: trigram of the folded name (see _fold) --> sorted positions. A
+  substring query is answered by intersecting the postings of its
+  trigrams and checking the few remaining candidates with the regex.
+- authoryearofbirth, authoryearofdeath: positions sorted by year, so that
+  the size of year ranges is found with a binary search.
+- downloads, to pick the most downloaded books with a partial sort.
+
+The index is saved next to the metadata (metadata_index.pkl for
+metadata.csv) and rebuilt when the metadata file changes.
+"""
+import os
+import pickle
+import re
+import string
+
+import numpy as np
+
+## bumped when the content of MetadataIndex changes
+INDEX_VERSION = 4
+
+LIST_FIELDS = ('language', 'subjects', 'LCC')
+YEAR_FIELDS = ('authoryearofbirth', 'authoryearofdeath')
+
+
+def _postings(lists):
+    '''Map each value to the sorted positions of the lists containing it,
+    and to those of the lists containing only this value.
+    '''
+    any_pos, only_pos = {}, {}
+    for i, values in enumerate(lists):
+        for v in set(values):
+            any_pos.setdefault(v, []).append(i)
+        if len(values) == 1:
+            only_pos.setdefault(values[0], []).append(i)
+    def as_arrays(d):
+        return {k: np.array(v, dtype=np.int32) for k, v in d.items()}
+    return as_arrays(any_pos), as_arrays(only_pos)
+
+
+def check_how(how):
+    '''Raise a ValueError if how is not a valid way to match a list field.
+    '''
+    if how not in ('only', 'any'):
+        raise ValueError("how must be 'only' or 'any', not %r" % (how,))
+
+
+def _trigrams(s):
+    return set(s[i:i + 3] for i in range(len(s) - 2))
+
+
+## non-ASCII character --> its folded form (see _fold)
+_folded_chars = {}
+
+
+def _fold_char(c):
+    f = _folded_chars.get(c)
+    if f is None:
+        ## e.g. the Kelvin sign, dotless i, long s
+        f = c
+        for a in string.ascii_lowercase:
+            if re.fullmatch(a, c, re.IGNORECASE):
+                f = a
+                break
+        _folded_chars[c] = f
+    return f
+
+
+def _fold(s):
+    '''Fold s for the author trigrams, one character for one character:
+    ASCII letters are lowercased, and the other characters replaced by the
+    ASCII letter they match with re.IGNORECASE, if any. An ASCII string
+    that matches part of s with re.IGNORECASE then folds to the folded
+    part of s, so the trigrams never drop a book the regex would match.
+    (str.casefold does not agree with the regex, e.g. on İ or ß.)
+    Only queries that are ASCII use the trigrams.
+    '''
+    if s.isascii():
+        return s.lower()
+    return "".join(c.lower() if c.isascii() else _fold_char(c) for c in s)
+
+
+class MetadataIndex(object):
+
+    def __init__(self, df, key=None):
+        '''Build the indexes of the typed metadata df.
+
+        key: identifies the version of the metadata the index was built
+        from (see load_index).
+        '''
+        self.key = key
+        self.n = len(df)
+        self.ids = df['id'].to_numpy(dtype=object)
+        self.downloads = df['downloads'].to_numpy(dtype=float)
+
+        self.lists = {}
+        for field in LIST_FIELDS:
+            if field in df:
+                self.lists[field] = _postings(df[field])
+
+        self.years = {}
+        self.year_values = {}
+        for field in YEAR_FIELDS:
+            values = df[field].to_numpy(dtype=float)
+            pos = np.flatnonzero(~np.isnan(values))
+            order = np.argsort(values[pos], kind='stable')
+            self.years[field] = (values[pos][order], pos[order].astype(np.int32))
+            self.year_values[field] = values
+
+        ## authors as an object array (None if missing) and their trigrams
+        self.authors = np.array(
+            [a if isinstance(a, str) else None for a in df['author']], dtype=object)
+        trigrams = {}
+        for i, a in enumerate(self.authors):
+            if a is not None:
+                for t in _trigrams(_fold(a)):
+                    trigrams.setdefault(t, []).append(i)
+        self.author_trigrams = {t: np.array(v, dtype=np.int32) for t, v in trigrams.items()}
+
+    def _member(self, pos, postings):
+        '''boolean array: which of the positions pos are in the sorted postings
+        '''
+        if postings is None or len(postings) == 0:
+            return np.zeros(len(pos), dtype=bool)
+        i = np.searchsorted(postings, pos)
+        np.minimum(i, len(postings) - 1, out=i)
+        return postings[i] == pos
+
+    def require_list(self, field):
+        '''Raise a ValueError if the metadata has no column field (e.g.
+        LCC, which is not in metadata.csv).
+        '''
+        if field not in self.lists:
+            raise ValueError("The metadata has no %s column; use the typed metadata "
+                             "(metadata.pkl) written by make_df_metadata" % field)
+
+    def _list_postings(self, field, value, how):
+        self.require_list(field)
+        check_how(how)
+        any_pos, only_pos = self.lists[field]
+        if how == 'only':
+            return only_pos.get(value)
+        return any_pos.get(value)
+
+    def list_select(self, pos, field, value, how='only'):
+        '''Books among the positions pos whose field (language, subjects or
+        LCC) contains value (how='any') or is exactly [value] (how='only').
+        '''
+        return pos[self._member(pos, self._list_postings(field, value, how))]
+
+    def list_count(self, field, value, how='only'):
+        '''Number of books selected by list_select among all books.
+        '''
+        postings = self._list_postings(field, value, how)
+        return 0 if postings is None else len(postings)
+
+    def year_select(self, pos, field, lower=None, upper=None):
+        '''Books among the positions pos with lower < field <= upper (either
+        bound may be None). Books where field is missing are never selected.
+        '''
+        values = self.year_values[field][pos]
+        keep = ~np.isnan(values)
+        if lower is not None:
+            keep &= values > lower
+        if upper is not None:
+            keep &= values <= upper
+        return pos[keep]
+
+    def year_count(self, field, lower=None, upper=None):
+        '''Number of books selected by year_select among all books.
+        '''
+        values = self.years[field][0]
+        start = 0 if lower is None else np.searchsorted(values, lower, side='right')
+        end = len(values) if upper is None else np.searchsorted(values, upper, side='right')
+        return max(0, end - start)
+
+    def _author_postings(self, s_sel):
+        '''trigram postings of s_sel, shortest first (None if too short,
+        or not ASCII)
+        '''
+        if not s_sel.isascii():
+            return None
+        grams = _trigrams(s_sel.lower())
+        if len(grams) == 0:
+            return None
+        return sorted((self.author_trigrams.get(t, ()) for t in grams), key=len)
+
+    def author_select(self, pos, s_sel):
+        '''Books among the positions pos whose author contains s_sel,
+        ignoring case.
+        '''
+        postings = self._author_postings(s_sel)
+        if postings is not None and len(postings[0]) < len(pos):
+            ## candidates: books with all the trigrams of s_sel
+            candidates = postings[0]
+            for p in postings[1:]:
+                if len(candidates) == 0:
+                    break
+                candidates = np.intersect1d(candidates, p, assume_unique=True)
+            pos = pos[self._member(pos, candidates)]
+        pattern = re.compile(re.escape(s_sel), re.IGNORECASE)
+        authors = self.authors
+        keep = [authors[i] is not None and pattern.search(authors[i]) is not None
+                for i in pos]
+        return pos[np.array(keep, dtype=bool)]
+
+    def author_count(self, s_sel):
+        '''Upper bound of the number of books selected by author_select
+        among all books.
+        '''
+        postings = self._author_postings(s_sel)
+        return self.n if postings is None else len(postings[0])
+
+    def top_downloads(self, pos, n=-1):
+        '''The positions pos sorted by decreasing downloads, keeping only
+        the n most downloaded if n > 0. Books with equal downloads keep their
+        order, and books without downloads come last.
+        '''
+        ## sort key, smallest first
+        key = -self.downloads[pos]
+        key[np.isnan(key)] = np.inf
+        if 0 < n < len(pos):
+            ## the n smallest keys, the first ones winning the ties at the
+            ## boundary, without sorting the rest
+            kth = key[np.argpartition(key, n - 1)[n - 1]]
+            below = np.flatnonzero(key < kth)
+            at = np.flatnonzero(key == kth)[:n - len(below)]
+            sel = np.sort(np.concatenate([below, at]))
+            return pos[sel[np.argsort(key[sel], kind='stable')]]
+        return pos[np.argsort(key, kind='stable')]
+
+
+def load_index(path, df):
+    '''Index of the metadata df, loaded from path.
+
+    The metadata file path is read from (csv or pkl) and the columns of
+    df identify the version of the index; if the saved index is missing or
+    was built from another version, it is rebuilt from df and saved (when
+    possible).
+    '''
+    stat = os.stat(path)
+    key = (INDEX_VERSION, os.path.abspath(path), stat.st_size, stat.st_mtime_ns, len(df),
+           tuple(df.columns))
+    path_index = os.path.splitext(path)[0] + '_index.pkl'
+    if os.path.isfile(path_index):
+        try:
+            with open(path_index, 'rb') as f:
+                index = pickle.load(f)
+            if index.key == key:
+                return index
+        except Exception:
+            ## unreadable or from an older version of this module
+            pass
+    index = MetadataIndex(df, key=key)
+    try:
+        with open(path_index + '.tmp', 'wb') as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path_index + '.tmp', path_index)
+    except OSError:
+        ## e.g. a read-only metadata folder; keep the index in memory only
+        pass
+    return index
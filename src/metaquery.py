@@ -14,36 +14,189 @@ import pandas as pd
 import numpy as np
 from collections import Counter
 import re
-import glob
+
+from .metadataparser import read_metadata
+from .metaindex import load_index, check_how
+
+class Query(object):
+    '''A lazy selection of books from the metadata.
+
+    Filters return a new Query with one more step in its plan; nothing is
+    computed until get_ids() or get_df() is called. Then, between two
+    top-n steps (filter_downloads with n > 0), the filters commute, so
+    they are run from the most to the least selective (as estimated from
+    the index), each one only looking at the books kept by the previous
+    ones. Sorting by downloads is done once, after the filters, and the n
+    most downloaded books are picked with a partial sort.
+
+    Example: Query(df, index).filter_lang('en').filter_downloads(100).get_ids()
+    '''
+
+    def __init__(self, df, index, pos=None, steps=()):
+        '''df: the typed metadata (see metadataparser.read_metadata).
+        index: its MetadataIndex (see metaindex.load_index).
+        pos: positions in df of the books to select from (default: all).
+        '''
+        self._df_all = df
+        self._index = index
+        self._pos = np.arange(index.n) if pos is None else pos
+        self._steps = tuple(steps)
+        self._result = None if len(self._steps) > 0 else self._pos
+
+    def _add(self, step):
+        if self._result is not None:
+            ## continue from the books already selected
+            return Query(self._df_all, self._index, self._result, (step,))
+        return Query(self._df_all, self._index, self._pos, self._steps + (step,))
+
+    def _list_filter(self, field, value, how):
+        ## fail now rather than when the result is needed
+        check_how(how)
+        self._index.require_list(field)
+        return self._add(('filter',
+            lambda index: index.list_count(field, value, how),
+            lambda index, pos: index.list_select(pos, field, value, how)))
+
+    def filter_lang(self, lang_sel, how='only'):
+        '''see meta_query.filter_lang'''
+        return self._list_filter('language', lang_sel, how)
+
+    def filter_subject(self, subject_sel, how='only'):
+        '''see meta_query.filter_subject'''
+        return self._list_filter('subjects', subject_sel, how)
+
+    def filter_LCC(self, lcc_sel, how='only'):
+        '''see meta_query.filter_LCC'''
+        return self._list_filter('LCC', lcc_sel, how)
+
+    def filter_year(self, y_sel, hmin=20):
+        '''see meta_query.filter_year'''
+        if isinstance(y_sel,(list,np.ndarray)):
+            y_birth, y_death = y_sel[1], y_sel[0]
+        else:
+            y_birth, y_death = y_sel, y_sel
+        def count(index):
+            return min(index.year_count('authoryearofbirth', upper=y_birth - hmin),
+                       index.year_count('authoryearofdeath', lower=y_death))
+        def select(index, pos):
+            pos = index.year_select(pos, 'authoryearofbirth', upper=y_birth - hmin)
+            return index.year_select(pos, 'authoryearofdeath', lower=y_death)
+        return self._add(('filter', count, select))
+
+    def filter_author(self, s_sel):
+        '''see meta_query.filter_author'''
+        return self._add(('filter',
+            lambda index: index.author_count(s_sel),
+            lambda index, pos: index.author_select(pos, s_sel)))
+
+    def filter_downloads(self, n=-1):
+        '''see meta_query.filter_downloads'''
+        return self._add(('downloads', n))
+
+    def positions(self):
+        '''run the plan; return the positions in df of the selected books
+        '''
+        if self._result is None:
+            index = self._index
+            pos = self._pos
+            ## split the plan at the top-n steps
+            filters, sort = [], False
+            for step in self._steps + (('downloads', None),):
+                if step[0] == 'filter':
+                    filters.append(step)
+                    continue
+                n = step[1]
+                for _, count, select in sorted(filters, key=lambda f: f[1](index)):
+                    if len(pos) == 0:
+                        break
+                    pos = select(index, pos)
+                filters = []
+                if n is not None and n > 0:
+                    pos, sort = index.top_downloads(pos, n), False
+                elif n is not None:
+                    sort = True
+                elif sort:
+                    pos = index.top_downloads(pos)
+            self._result = pos
+        return self._result
+
+    def get_ids(self):
+        '''return list of PG-ids of the selected books
+        '''
+        return self._index.ids[self.positions()].tolist()
+
+    def get_df(self):
+        '''return the dataframe of the selected books
+        '''
+        return self._df_all.iloc[self.positions()]
+
 
 class meta_query(object):
 
     def __init__(self, path='../metadata/metadata.csv', filter_exist=True):
-        '''filter_exist: Only keep entries in metadata for which we have the downloaded text.
+        '''path: metadata.csv, or the typed metadata.pkl (see metadataparser.read_metadata).
+        The columns language, subjects and LCC hold lists of strings.
+        filter_exist: Only keep entries in metadata for which we have the downloaded text.
+
+        Filters are answered from the indexes in metaindex, which are
+        built the first time and saved next to the metadata. They are
+        only applied when the result is needed (see Query).
+
+        The metadata, its index and the books found in data/text are
+        shared by all instances in a process (see get_catalog and
+        available_positions), so creating a meta_query is cheap.
         '''
 
-        self.df = pd.read_csv(path) ## the dataframe on which we apply filters
+        self._df_all, self._index = get_catalog(path) ## all books in the metadata
         if filter_exist == True: ## filter the books for which we have the data
             path_text = os.path.abspath(os.path.join(path,os.pardir,os.pardir,'data','text'))
-            list_files = []
-            for file in list(glob.glob( path_text+'/PG*_text.txt' )):
-                list_files += [file]
-            list_ids = sorted([ h.split('/')[-1].split('_text')[0] for h in list_files ])
-            df = self.df
-            df_new = df[df['id'].isin(list_ids)]
-            self.df = df_new
-        self.df_original = self.df ## keep the original dataframe
+            pos = available_positions(path_text, self._index)
+        else:
+            pos = np.arange(self._index.n)
+        self._query_original = Query(self._df_all, self._index, pos)
+        self._df_original = None
+        self.reset()
+
+    @property
+    def df_original(self):
+        '''the original dataframe (without filters)
+        '''
+        if self._df_original is None:
+            self._df_original = self._query_original.get_df()
+        return self._df_original
+
+    ## The filtered dataframe is a Query, and only built when it is asked for.
+    @property
+    def df(self):
+        if self._df is None:
+            self._df = self._query.get_df()
+        return self._df
+
+    @df.setter
+    def df(self, df):
+        self._df = df
+        self._query = Query(self._df_all, self._index,
+                            self._df_all.index.get_indexer(df.index))
+
+    def query(self):
+        '''return the current selection as a Query, to chain more filters
+        '''
+        return self._query
+
+    def _add(self, query):
+        self._query = query
+        self._df = None
 
     def reset(self):
         '''reset df to original dataframe (remove all filters)
         '''
-        self.df = self.df_original
+        self._query = self._query_original
+        self._df = self._df_original
 
     def get_ids(self):
         '''return list of PG-ids of filtered dataframe
         '''
-        list_book_ids = self.df['id']
-        return list(list_book_ids)
+        return self._query.get_ids()
 
     def get_df(self):
         '''return the filtered dataframe
@@ -62,48 +215,34 @@ class meta_query(object):
             'only' to select books that only contain lang_sel
             'any' to select books that contain lang_sel and maybe other langs
         """
-        if how == 'only':
-            s = self.df[self.df['language'] == "['%s']"%(lang_sel)]
-        elif how =='any':
-            s = self.df[self.df['language'].str.contains("'%s'"%(lang_sel)).replace(np.nan,False)]
-        else:
-            s = meta
-        self.df = s
+        self._add(self._query.filter_lang(lang_sel, how=how))
 
     ### LANGUAGE
     def get_lang(self):
-        list_lang = [[k for k in h.strip("[]")[1:-1].replace("', '","_").split('_')] for h in self.df['language'].dropna()]
-        list_lang_flat = [item for sublist in list_lang for item in sublist]
-        list_lang_set = sorted(list(set(list_lang_flat)))
+        list_lang_set = sorted(set(self.df['language'].explode().dropna()))
         return list_lang_set
 
     def get_lang_counts(self):
-        list_lang = [[k for k in h.strip("[]")[1:-1].replace("', '","_").split('_')] for h in self.df['language'].dropna()]
-        list_lang_flat = [item for sublist in list_lang for item in sublist]
-        return Counter(list_lang_flat)
+        return Counter(self.df['language'].explode().dropna())
     ### SUBJECTS
     def get_subjects(self):
-        list_subjects = [[k for k in h.strip("{}")[1:-1].replace("', '","_").split('_')] for h in self.df['subjects'].replace('set()',np.nan).dropna()]
-        list_subjects_flat = [item for sublist in list_subjects for item in sublist]
-        list_subjects_set = sorted(list(set(list_subjects_flat)))
+        list_subjects_set = sorted(set(self.df['subjects'].explode().dropna()))
         return list_subjects_set
 
     def get_subjects_counts(self):
-        list_subjects = [[k for k in h.strip("{}")[1:-1].replace("', '","_").split('_')] for h in self.df['subjects'].replace('set()',np.nan).dropna()]
-        list_subjects_flat = [item for sublist in list_subjects for item in sublist]
-        return Counter(list_subjects_flat)
+        return Counter(self.df['subjects'].explode().dropna())
 
     def filter_subject(self,subject_sel,how='only'):
         ## filter metadata for subjects
         ## how == 'only', books that only contain subject
         ## how == 'any', all books that contain subject (and potentially others too)
-        if how == 'only':
-            s = self.df[self.df['subjects'] == "{'%s'}"%(subject_sel)]
-        elif how =='any':
-            s = self.df[self.df['subjects'].str.contains("'%s'"%(re.escape(subject_sel))).replace(np.nan,False)]
-        else:
-            s = meta
-        self.df = s
+        self._add(self._query.filter_subject(subject_sel, how=how))
+
+    def filter_LCC(self,lcc_sel,how='only'):
+        ## filter metadata for Library of Congress classes, e.g. 'PS'
+        ## how == 'only', books that only have this class
+        ## how == 'any', all books that have this class (and potentially others too)
+        self._add(self._query.filter_LCC(lcc_sel, how=how))
 
     ### TIME
     def filter_year(self,y_sel,hmin=20):
@@ -116,26 +255,78 @@ class meta_query(object):
         - 847 books with only authoryearofdeath
         - 13996 books missing both
         '''
-        if isinstance(y_sel,(list,np.ndarray)):
-            s = self.df[ (self.df['authoryearofbirth'] <= y_sel[1] - hmin)&(self.df['authoryearofdeath']>y_sel[0])]
-        else:
-            s = self.df[ (self.df['authoryearofbirth'] <= y_sel - hmin)&(self.df['authoryearofdeath']>y_sel)]
-        self.df = s
+        self._add(self._query.filter_year(y_sel, hmin=hmin))
 
     ### AUTHOR
     def filter_author(self,s_sel):
-        s = self.df[ self.df['author'].str.contains(re.escape(s_sel),case=False).replace(np.nan,False)] 
-        self.df = s
+        self._add(self._query.filter_author(s_sel))
 
     ### Sort by the n most downloaded
     def filter_downloads(self,n=-1):
         ### keep only the n most downloaded
         ### if n = -1, keep all
-        s = self.df.sort_values('downloads',ascending=False)
-        if n>0:
-            s=s.iloc[:n]
-        self.df = s
+        ### books with the same downloads keep their order
+        self._add(self._query.filter_downloads(n))
+
+
+## catalogs loaded so far in this process, by path of the metadata
+_catalogs = {}
+## books found in text folders, by path of the folder
+_available = {}
+
+
+def _catalog_key(path):
+    '''size and mtime of the metadata file, and of the typed metadata
+    read_metadata uses instead of a csv-file
+    '''
+    key = []
+    for p in (path, os.path.splitext(path)[0] + '.pkl'):
+        if os.path.isfile(p):
+            stat = os.stat(p)
+            key.append((p, stat.st_size, stat.st_mtime_ns))
+    return tuple(key)
+
+
+def get_catalog(path):
+    '''Return the typed metadata in path and its index (see metaindex).
+
+    They are loaded only once per process, and again when the metadata
+    file changes.
+    '''
+    path = os.path.abspath(path)
+    key = _catalog_key(path)
+    cached = _catalogs.get(path)
+    if cached is None or cached[0] != key:
+        df = read_metadata(path)
+        _catalogs[path] = (key, df, load_index(path, df))
+    return _catalogs[path][1:]
+
 
+def available_positions(path_text, index):
+    '''Positions in the metadata of index of the books with a
+    PG*_text.txt file in the folder path_text.
 
+    The folder is only listed again when its mtime changes, i.e. when
+    files are added, removed or renamed.
+    '''
+    try:
+        mtime = os.stat(path_text).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    cached = _available.get(path_text)
+    if cached is None or cached[0] != mtime or cached[1] is not index:
+        list_ids = []
+        if mtime is not None:
+            with os.scandir(path_text) as entries:
+                list_ids = [e.name.split('_text')[0] for e in entries
+                            if e.name.startswith('PG') and e.name.endswith('_text.txt')]
+        pos = np.flatnonzero(np.isin(index.ids, list_ids))
+        _available[path_text] = (mtime, index, pos)
+    return _available[path_text][2]
 
 
+def clear_catalog_cache():
+    '''Forget all loaded catalogs and listed text folders.
+    '''
+    _catalogs.clear()
+    _available.clear()
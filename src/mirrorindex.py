@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+An index of the books in the mirror, built in a single pass.
+
+For every directory of the mirror, the index keeps its status change time
+(ctime), its subdirectories and its book files (12345-0.txt or pg12345.txt.utf8,
+see utils.populate_raw_from_mirror). From this, it knows every variant of
+every book (PG number --> paths), which is all that the duplicates and the
+population of raw/ need, so the mirror is only traversed once.
+
+The index is saved (by default next to the mirror, as .mirror_index.pkl,
+since rsync would delete it inside the mirror). The next scan only lists
+the directories whose ctime changed. A file added, removed or replaced
+(rsync renames its temporary files into place) changes the ctime of its
+directory, and so does restoring the directory's mtime afterwards (which
+rsync -a does), so the ctime cannot be reset to a saved value, unlike the
+mtime. The other directories are only stat-ed, and their saved entries
+are reused.
+"""
+import os
+import pickle
+
+from .utils import _raw_PG_number
+
+## bumped when the content of MirrorIndex changes
+INDEX_VERSION = 2
+
+
+def default_index_path(mirror_dir):
+    '''Where the index of mirror_dir is saved: next to it, e.g.
+    data/.mirror_index.pkl for data/.mirror/.
+    '''
+    mirror_dir = os.path.abspath(mirror_dir)
+    return os.path.join(os.path.dirname(mirror_dir), ".%s_index.pkl" % os.path.basename(mirror_dir).lstrip("."))
+
+
+def _list_dir(path):
+    '''Subdirectories and book files, as (name, PG number), of a directory.
+    '''
+    subdirs, files = [], []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                elif entry.is_file():
+                    PG_number = _raw_PG_number(entry.name)
+                    if PG_number is not None:
+                        files.append((entry.name, PG_number))
+            except OSError:
+                pass
+    subdirs.sort()
+    files.sort()
+    return tuple(subdirs), tuple(files)
+
+
+class MirrorIndex(object):
+
+    def __init__(self, mirror_dir, previous=None):
+        '''Scan mirror_dir, reusing the entries of the directories that did
+        not change since the previous index (a MirrorIndex or None).
+
+        Attributes:
+        - dirs: relative path --> (ctime_ns, subdirectories, book files)
+        - books: PG number --> relative paths of its files, sorted
+        - listed, reused: number of directories listed and reused
+        '''
+        self.mirror_dir = mirror_dir
+        self.key = (INDEX_VERSION, os.path.abspath(mirror_dir))
+        previous_dirs = {}
+        if previous is not None and previous.key == self.key:
+            previous_dirs = previous.dirs
+        self.dirs = {}
+        self.listed, self.reused = 0, 0
+        stack = [""]
+        while len(stack) > 0:
+            rel = stack.pop()
+            path = os.path.join(mirror_dir, rel)
+            try:
+                ctime = os.stat(path).st_ctime_ns
+                entry = previous_dirs.get(rel)
+                if entry is not None and entry[0] == ctime:
+                    self.reused += 1
+                    subdirs, files = entry[1], entry[2]
+                else:
+                    self.listed += 1
+                    subdirs, files = _list_dir(path)
+            except OSError:
+                ## like os.walk, skip unreadable directories
+                continue
+            self.dirs[rel] = (ctime, subdirs, files)
+            stack.extend(os.path.join(rel, d) for d in reversed(subdirs))
+        self.books = {}
+        for rel in sorted(self.dirs):
+            for name, PG_number in self.dirs[rel][2]:
+                self.books.setdefault(PG_number, []).append(os.path.join(rel, name))
+
+    def __len__(self):
+        return len(self.books)
+
+    def path(self, rel):
+        '''Path of a file of the index, within the mirror.
+        '''
+        return os.path.join(self.mirror_dir, rel)
+
+    def iter_files(self):
+        '''Iterate over the (path, name) of all book files, by directory.
+        '''
+        for rel in sorted(self.dirs):
+            for name, _ in self.dirs[rel][2]:
+                yield self.path(os.path.join(rel, name)), name
+
+    def duplicates(self):
+        '''The pg*.txt.utf8 files of the books that also have a -0.txt
+        file, which is the one used.
+        '''
+        dups = []
+        for PG_number, rels in self.books.items():
+            if any(rel.endswith("-0.txt") for rel in rels):
+                dups += [self.path(rel) for rel in rels if rel.endswith(".txt.utf8")]
+        return dups
+
+
+def load_mirror_index(mirror_dir, path=None):
+    '''Index of mirror_dir, updated from the index saved in path
+    (default_index_path if None) and saved back.
+    '''
+    if path is None:
+        path = default_index_path(mirror_dir)
+    previous = None
+    if os.path.isfile(path):
+        try:
+            with open(path, 'rb') as f:
+                previous = pickle.load(f)
+        except Exception:
+            ## unreadable or from an older version of this module
+            previous = None
+    index = MirrorIndex(mirror_dir, previous=previous)
+    try:
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+    except OSError:
+        ## keep the index in memory only
+        pass
+    return index
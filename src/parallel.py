@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Run process_book over many books, and map functions over a pool of
+processes.
+
+process_books takes a list of jobs, i.e. dicts of keyword arguments for
+process_book, and yields one (job, stats, error) tuple per book:
+
+- stats is the dict returned by process_book (None if the book was skipped),
+- error is None, or a (exception, traceback string) pair if the book failed.
+
+Books never write to the log file themselves; the caller gets the stats
+back and appends them to the log, so there is a single writer even when
+many processes are busy. process_books runs the books serially; on
+several processes, src.scheduler.process_books_scheduled runs the same
+_process_job in its workers.
+
+parallel_map is a generic, order-preserving map over a process pool, used
+for the other corpus-wide jobs (e.g. parsing metadata).
+"""
+import os
+import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from .pipeline import process_book
+from .tokenizer import warm_tokenizers
+
+
+def _process_job(job):
+    """
+    Process a single job and capture any error.
+
+    This is the function that runs in the worker processes.
+    """
+    try:
+        stats = process_book(**dict(job, log_file=""))
+        return job, stats, None
+    except Exception as e:
+        return job, None, (e, traceback.format_exc())
+
+
+def _init_worker(languages):
+    """
+    Load the tokenizers of all languages when a worker process starts.
+
+    A language without a model is skipped here; the books in that language
+    will report the error when they are processed.
+    """
+    for language in languages:
+        try:
+            warm_tokenizers([language])
+        except LookupError:
+            pass
+
+
+def process_books(jobs):
+    """
+    Process jobs one after the other in the current process.
+    """
+    for job in jobs:
+        yield _process_job(job)
+
+
+def parallel_map(f, items, workers=None, max_in_flight=None):
+    """
+    Apply f to every item on a pool of worker processes.
+
+    Like map, results are yielded in the order of items. Items are read
+    lazily, so that at most max_in_flight of them (defaults to 4 times the
+    number of workers) are held in memory at any time. With workers=1, f is
+    simply applied in the current process.
+
+    f must be picklable, i.e. defined at the top level of a module.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        for item in items:
+            yield f(item)
+        return
+    if max_in_flight is None:
+        max_in_flight = 4 * workers
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for result in executor_map(executor, f, items, max_in_flight):
+            yield result
+
+
+def executor_map(executor, f, items, max_in_flight):
+    """
+    Apply f to every item on an existing executor, like parallel_map.
+    """
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(f, item))
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
@@ -1,10 +1,30 @@
 # -*- coding: utf-8 -*-
-from .cleanup import strip_headers
-from .tokenizer import tokenize_text
+from .cleanup import strip_headers, iter_strip_headers, iter_lines
+from .tokenizer import tokenize_text, iter_tokenize_text, iter_tokenize_chunks
+from .tokenizer import tokenize_text_fast, iter_tokenize_text_fast, iter_tokenize_chunks_fast
+from .manifest import file_digest, function_version
+from .tokenstream import open_tokens_writer, tokens_path, sentences_path
+from .profiling import StageTimer
 from collections import Counter
 import io
 import os
 
+# cleanup functions that can also be run one line at a time
+STREAMING_CLEANUPS = {
+    strip_headers: iter_strip_headers,
+}
+# tokenizers that can also be run one sentence at a time
+STREAMING_TOKENIZERS = {
+    tokenize_text: iter_tokenize_text,
+    tokenize_text_fast: iter_tokenize_text_fast,
+}
+# tokenizers that can also be run in chunks of sentences, in parallel
+CHUNKED_TOKENIZERS = {
+    tokenize_text: iter_tokenize_chunks,
+    tokenize_text_fast: iter_tokenize_chunks_fast,
+}
+
+
 def process_book(
 	path_to_raw_file=None,
 	text_dir=None,
@@ -14,7 +34,13 @@ def process_book(
 	cleanup_f=strip_headers,
     overwrite_all=False,
     language="english",
-    log_file=""
+    log_file="",
+    manifest_entry=None,
+    tokens_format="text",
+    vocabulary_file=None,
+    chunk_map=None,
+    chunk_size=1000000,
+    profile=False
 	):
     """
     Process a book, from raw data to counts.
@@ -23,22 +49,62 @@ def process_book(
 
     1. raw: the book as downloaded from PG site.
     2. text: the book with headers/legal notices/etc removed.
-    3. tokens: the tokenized book. One token per line.
+    3. tokens: the tokenized book. One token per line (or, in the binary
+       format, an array of vocabulary ids, see src.tokenstream).
     4. counts: the counts of all types. One type per line.
 
     This function takes a file at the 'raw' level and computes the counts,
     saving to disk the intermediate 'text' and 'tokens' files.
 
+    With the cleanup functions in STREAMING_CLEANUPS (strip_headers), the
+    raw file is cleaned up line by line into the text file, which the
+    tokenizer then reads back; the raw text is never held in memory.
+
     Overwrite policy
     ----------------
     By default a book is processed in full except if all the 
     files already exist (raw,text,tokens and counts). The overwrite_all
     keyword can cahnge this behaviour.
 
+    If the manifest_entry of the book is given (an empty dict for a book
+    that is not in the manifest yet), each stage is only recomputed if its
+    inputs changed:
+
+    - text, if the content of the raw file or the version of cleanup_f
+      changed, or the text file is missing.
+    - tokens and counts, if the content of the text file, the version of
+      tokenize_f, the language or the tokens format changed, or one of the
+      files is missing.
+
     Parameters
     ----------
     overwrite_all : bool
         If set to True, everything is processed regargless of existing files.
+    manifest_entry : dict
+        The record of the book from the manifest (see src.manifest).
+    tokens_format : str
+        'text' (default) or 'binary'.
+    vocabulary_file : str
+        The vocabulary used by the binary tokens format. Defaults to
+        vocab.txt in tokens_dir.
+    chunk_map : function
+        If given, the text is tokenized in chunks of about chunk_size
+        characters, mapped with chunk_map (e.g. src.parallel.parallel_map
+        to use several processes for a large book). The output is the same.
+        Only for the tokenizers in CHUNKED_TOKENIZERS.
+    chunk_size : int
+        Size of the chunks, in characters.
+    profile : bool
+        If True, the stats include the time spent in each stage, the
+        bytes read and written and the peak memory (see src.profiling).
+
+    Returns
+    -------
+    dict or None
+        Statistics of the processed book (the fields written to the log
+        file, see log_line) and the list of stages that were run, or None
+        if the book was skipped. With a manifest_entry, this is the new
+        record of the book in the manifest.
     """
     if text_dir is None:
         raise ValueError("You must specify a path to save the text files.")
@@ -55,44 +121,187 @@ def process_book(
     # get PG number
     PG_number = path_to_raw_file.split("/")[-1].split("_")[0][2:]
 
-    if overwrite_all or\
-        (not os.path.isfile(os.path.join(text_dir,"PG%s_text.txt"%PG_number))) or \
-        (not os.path.isfile(os.path.join(tokens_dir,"PG%s_tokens.txt"%PG_number))) or \
-        (not os.path.isfile(os.path.join(counts_dir,"PG%s_counts.txt"%PG_number))):
+    text_file = os.path.join(text_dir,"PG%s_text.txt"%PG_number)
+    tokens_file = tokens_path(tokens_dir, PG_number, tokens_format)
+    counts_file = os.path.join(counts_dir,"PG%s_counts.txt"%PG_number)
+
+    if manifest_entry is None:
+        if not (overwrite_all or\
+            (not os.path.isfile(text_file)) or \
+            (not os.path.isfile(tokens_file)) or \
+            (not os.path.isfile(counts_file))):
+            return None
+        stats = {}
+        do_text = do_tokens = True
+    else:
+        stats = dict(manifest_entry)
+        # only hash the raw file if it was touched since the last time
+        raw_stat = os.stat(path_to_raw_file)
+        if stats.get("raw_size") != raw_stat.st_size or \
+            stats.get("raw_mtime") != raw_stat.st_mtime_ns:
+            stats["raw_sha1"] = file_digest(path_to_raw_file)
+            stats["raw_size"] = raw_stat.st_size
+            stats["raw_mtime"] = raw_stat.st_mtime_ns
+        do_text = overwrite_all or\
+            (not os.path.isfile(text_file)) or \
+            stats["raw_sha1"] != manifest_entry.get("raw_sha1") or \
+            function_version(cleanup_f) != manifest_entry.get("cleanup")
+        do_tokens = overwrite_all or\
+            (not os.path.isfile(tokens_file)) or \
+            (not os.path.isfile(counts_file)) or \
+            function_version(tokenize_f) != manifest_entry.get("tokenizer") or \
+            language != manifest_entry.get("language") or \
+            tokens_format != manifest_entry.get("tokens_format", "text")
+
+    stats["PG"] = "PG" + str(PG_number)
+    stats["stages"] = []
+    timer = StageTimer(enabled=profile)
+    files_in, files_out = [], []
+
+    clean = None
+    if do_text and cleanup_f in STREAMING_CLEANUPS:
+        # stream the raw file through the cleanup into the text file, so
+        # that neither the raw nor the clean text is held in memory
+        # (reading is timed as part of strip_headers). The text file is
+        # written under a temporary name, so that a decoding error half
+        # way leaves no truncated text file behind.
+        raw_nl = 0
+        sep = str(os.linesep)
+        with io.open(path_to_raw_file, encoding="UTF-8") as f_in:
+            def chunks():
+                nonlocal raw_nl
+                for chunk in f_in:
+                    raw_nl += chunk.count("\n")
+                    yield chunk
+            lines = STREAMING_CLEANUPS[cleanup_f](iter_lines(chunks()))
+            n_lines = 0
+            try:
+                with io.open(text_file + ".tmp", "w", encoding="UTF-8") as f_out:
+                    batch = []
+                    for line in timer.iterate("strip_headers", lines):
+                        batch.append(line)
+                        if len(batch) == 10000:
+                            with timer.stage("write_text"):
+                                f_out.write((sep if n_lines > 0 else "") + sep.join(batch))
+                            n_lines += len(batch)
+                            batch = []
+                    with timer.stage("write_text"):
+                        f_out.write((sep if n_lines > 0 and len(batch) > 0 else "") + sep.join(batch))
+                    n_lines += len(batch)
+                # the footer stops the cleanup before the end of the file;
+                # the rest is counted before the text file is put in place,
+                # so that a decoding error there leaves no text file either
+                for chunk in f_in:
+                    raw_nl += chunk.count("\n")
+                os.replace(text_file + ".tmp", text_file)
+            except BaseException:
+                if os.path.exists(text_file + ".tmp"):
+                    os.remove(text_file + ".tmp")
+                raise
+        clean_nl = max(n_lines - 1, 0) * sep.count("\n")
+        files_in.append(path_to_raw_file)
+        files_out.append(text_file)
+    elif do_text:
         # read raw file
-        with io.open(path_to_raw_file, encoding="UTF-8") as f:
-            text = f.read()
+        with timer.stage("read"):
+            with io.open(path_to_raw_file, encoding="UTF-8") as f:
+                text = f.read()
+        raw_nl = text.count("\n")
+        files_in.append(path_to_raw_file)
 
-        # clean it up
-        clean = cleanup_f(text)
+        # clean it up (the raw text is not needed afterwards)
+        with timer.stage("strip_headers"):
+            clean = cleanup_f(text)
+        del text
 
         # write text file
-        target_file = os.path.join(text_dir,"PG%s_text.txt"%PG_number)
-        with io.open(target_file,"w", encoding="UTF-8") as f:
-            f.write(clean)
+        with timer.stage("write_text"):
+            with io.open(text_file,"w", encoding="UTF-8") as f:
+                f.write(clean)
+        files_out.append(text_file)
+        clean_nl = clean.count("\n")
 
-        # compute tokens
-        tokens = tokenize_f(clean, language=language)
-   
-        # write tokens file
-        target_file = os.path.join(tokens_dir,"PG%s_tokens.txt"%PG_number)
-        with io.open(target_file,"w", encoding="UTF-8") as f:
-            f.write("\n".join(tokens)+"\n")
+    if do_text:
+        stats["raw_nl"] = raw_nl
+        stats["clean_nl"] = clean_nl
+        stats["stages"].append("text")
+        if manifest_entry is not None:
+            stats["cleanup"] = function_version(cleanup_f)
+            stats["text_sha1"] = file_digest(text_file)
+            if stats["text_sha1"] != manifest_entry.get("text_sha1"):
+                do_tokens = True
 
-        # compute counts
-        counts = Counter(tokens)
+    if do_tokens:
+        # read the clean text if it was not computed here, or streamed
+        if clean is None:
+            with timer.stage("read"):
+                with io.open(text_file, encoding="UTF-8") as f:
+                    clean = f.read()
+            files_in.append(text_file)
+
+        # compute tokens, one sentence at a time if the tokenizer allows it
+        # (or in parallel chunks), writing and counting them as they come
+        with timer.stage("tokenize"):
+            if chunk_map is not None and tokenize_f in CHUNKED_TOKENIZERS:
+                sentences = CHUNKED_TOKENIZERS[tokenize_f](
+                    clean, language=language, map_f=chunk_map, chunk_size=chunk_size)
+            elif tokenize_f in STREAMING_TOKENIZERS:
+                sentences = STREAMING_TOKENIZERS[tokenize_f](clean, language=language)
+            else:
+                sentences = [tokenize_f(clean, language=language)]
+        counts = Counter()
+
+        # write tokens file and compute counts
+        writer = open_tokens_writer(tokens_dir, PG_number, tokens_format,
+                                    vocabulary_file=vocabulary_file)
+        try:
+            for sent_tokens in timer.iterate("tokenize", sentences):
+                with timer.stage("write_tokens"):
+                    writer.write_sentence(sent_tokens)
+                with timer.stage("count"):
+                    counts.update(sent_tokens)
+        finally:
+            with timer.stage("write_tokens"):
+                writer.close()
+        L = writer.n_tokens
+        files_out.append(tokens_file)
+        if tokens_format == "binary":
+            files_out.append(sentences_path(tokens_dir, PG_number))
         
         # write counts file
-        target_file = os.path.join(counts_dir,"PG%s_counts.txt"%PG_number)
-        with io.open(target_file,"w", encoding="UTF-8") as f:
-            f.write("\n".join([w+"\t"+str(c) for w,c in counts.most_common()])+"\n")
-
-        # write log info if log_file is not None
-        if log_file != "":
-            raw_nl = text.count("\n")
-            clean_nl = clean.count("\n")
-            L = len(tokens)
-            V = len(counts)
-            with io.open(log_file, "a") as f:
-               f.write("PG"+str(PG_number)+"\t"+language+"\t"+str(raw_nl)+"\t"+str(clean_nl)+"\t"+str(L)+"\t"+str(V)+"\n")
-                
+        with timer.stage("write_counts"):
+            with io.open(counts_file,"w", encoding="UTF-8") as f:
+                f.write("\n".join([w+"\t"+str(c) for w,c in counts.most_common()])+"\n")
+        files_out.append(counts_file)
+
+        stats["language"] = language
+        stats["L"] = L
+        stats["V"] = len(counts)
+        stats["stages"].append("tokens")
+        if manifest_entry is not None:
+            stats["tokenizer"] = function_version(tokenize_f)
+            stats["tokens_format"] = tokens_format
+
+    if profile:
+        stats["profile"] = timer.record(
+            bytes_in=sum(os.path.getsize(path) for path in files_in),
+            bytes_out=sum(os.path.getsize(path) for path in files_out))
+
+    # write log info if log_file is not None
+    if log_file != "" and len(stats["stages"]) > 0:
+        with io.open(log_file, "a") as f:
+            f.write(log_line(stats))
+    return stats
+
+
+def log_line(stats):
+    """
+    Format the statistics returned by process_book as a line of the log file.
+
+    Columns are PG id, language, number of newlines in the raw and in the
+    clean text, number of tokens (L) and number of types (V).
+    """
+    return "\t".join([
+        stats["PG"], stats["language"], str(stats["raw_nl"]),
+        str(stats["clean_nl"]), str(stats["L"]), str(stats["V"])
+        ]) + "\n"
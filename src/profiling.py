@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage timing of process_book, and reports over many books.
+
+With profile=True, process_book adds a 'profile' record to its stats:
+
+- stages: for each stage (read, strip_headers, write_text, tokenize,
+  write_tokens, count, write_counts), the wall and CPU time in seconds,
+- bytes_in, bytes_out: size of the files read and written,
+- peak_rss: peak resident memory of the process so far, in bytes. With
+  the persistent workers of process_books_scheduled, this is the peak of
+  the worker since it started, not of this book,
+- rss_growth: how much the book raised this peak, in bytes (0 if the
+  process had already used more memory before).
+
+process_data.py --profile appends one such record per book, as a line of
+json, to a file; summarize and format_report turn these lines into
+percentiles per stage and the list of the slowest books.
+"""
+import io
+import json
+import time
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+STAGES = ("read", "strip_headers", "write_text", "tokenize",
+          "write_tokens", "count", "write_counts")
+
+
+class _Stage(object):
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+
+    def __exit__(self, *exc):
+        self.timer.add(self.name, time.perf_counter() - self.wall,
+                       time.process_time() - self.cpu)
+
+
+class _NullStage(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+_null_stage = _NullStage()
+
+
+class StageTimer(object):
+    """
+    Accumulate wall and CPU time per stage.
+
+    If enabled is False, nothing is measured, so that the timer can be
+    left in the code at (almost) no cost.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.wall = {}
+        self.cpu = {}
+        self.start_rss = peak_rss() if enabled else None
+
+    def add(self, name, wall, cpu):
+        self.wall[name] = self.wall.get(name, 0.0) + wall
+        self.cpu[name] = self.cpu.get(name, 0.0) + cpu
+
+    def stage(self, name):
+        """
+        Context manager timing the code in its block as stage name.
+        """
+        if not self.enabled:
+            return _null_stage
+        return _Stage(self, name)
+
+    def iterate(self, name, iterable):
+        """
+        Iterate over iterable, timing the production of each item as
+        stage name (e.g. the tokenization of each sentence).
+        """
+        if not self.enabled:
+            return iterable
+        return self._iterate(name, iterable)
+
+    def _iterate(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            wall, cpu = time.perf_counter(), time.process_time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.add(name, time.perf_counter() - wall, time.process_time() - cpu)
+            yield item
+
+    def record(self, bytes_in=0, bytes_out=0):
+        """
+        The profile record of a book (see the module docstring).
+        """
+        rss = peak_rss()
+        return {
+            "stages": dict((name, {"wall": self.wall[name], "cpu": self.cpu[name]})
+                           for name in STAGES if name in self.wall),
+            "bytes_in": bytes_in,
+            "bytes_out": bytes_out,
+            "peak_rss": rss,
+            "rss_growth": rss - self.start_rss if rss is not None and self.start_rss is not None else None,
+        }
+
+
+def peak_rss():
+    """
+    Peak resident memory of the current process since it started, in
+    bytes (None if unknown).
+    """
+    if resource is None:
+        return None
+    # in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def profile_line(stats):
+    """
+    Format the profile of a book (from the stats of process_book) as a
+    line of json.
+    """
+    record = dict(stats["profile"], PG=stats["PG"])
+    return json.dumps(record, sort_keys=True) + "\n"
+
+
+def read_profiles(path):
+    """
+    Read the lines written with profile_line.
+    """
+    with io.open(path, encoding="UTF-8") as f:
+        return [json.loads(line) for line in f if line.strip() != ""]
+
+
+def summarize(records, n_slowest=10):
+    """
+    Summarize the profiles of many books.
+
+    Returns
+    -------
+    dict
+        - books: number of books
+        - stages: for each stage, the number of books, the total wall and
+          CPU time and the p50, p95 and p99 of the wall time
+        - slowest: the n_slowest books with the longest total wall time,
+          as (PG id, seconds) pairs
+        - bytes_in, bytes_out: totals
+        - peak_rss: the largest peak_rss, i.e. the peak memory of the
+          process (or worker) that used the most
+        - largest_growth: the book that raised the peak of its process
+          the most, as a (PG id, bytes) pair (None if unknown)
+    """
+    stages = {}
+    for name in STAGES:
+        wall = np.array([r["stages"][name]["wall"] for r in records if name in r["stages"]])
+        if len(wall) == 0:
+            continue
+        cpu = np.array([r["stages"][name]["cpu"] for r in records if name in r["stages"]])
+        p50, p95, p99 = np.percentile(wall, [50, 95, 99])
+        stages[name] = {"books": len(wall), "wall": float(wall.sum()), "cpu": float(cpu.sum()),
+                        "p50": float(p50), "p95": float(p95), "p99": float(p99)}
+    totals = [(r["PG"], sum(s["wall"] for s in r["stages"].values())) for r in records]
+    totals.sort(key=lambda x: -x[1])
+    rss = [r["peak_rss"] for r in records if r.get("peak_rss") is not None]
+    growth = [(r["PG"], r["rss_growth"]) for r in records if r.get("rss_growth") is not None]
+    return {
+        "books": len(records),
+        "stages": stages,
+        "slowest": totals[:n_slowest],
+        "bytes_in": sum(r["bytes_in"] for r in records),
+        "bytes_out": sum(r["bytes_out"] for r in records),
+        "peak_rss": max(rss) if len(rss) > 0 else None,
+        "largest_growth": max(growth, key=lambda x: x[1]) if len(growth) > 0 else None,
+    }
+
+
+def format_report(summary):
+    """
+    Format a summary (see summarize) as a text table.
+    """
+    lines = ["%d books, %.1f MB in, %.1f MB out" % (
+        summary["books"], summary["bytes_in"] / 2**20, summary["bytes_out"] / 2**20)]
+    if summary["peak_rss"] is not None:
+        lines.append("peak RSS of a process (over all its books) %.1f MB" % (summary["peak_rss"] / 2**20))
+    if summary.get("largest_growth") is not None:
+        PG_id, growth = summary["largest_growth"]
+        lines.append("largest growth of the peak RSS during a book %.1f MB (%s)" % (growth / 2**20, PG_id))
+    lines.append("")
+    lines.append("%-14s %8s %10s %10s %10s %10s %10s" % (
+        "stage", "books", "wall [s]", "cpu [s]", "p50 [ms]", "p95 [ms]", "p99 [ms]"))
+    for name, s in summary["stages"].items():
+        lines.append("%-14s %8d %10.2f %10.2f %10.2f %10.2f %10.2f" % (
+            name, s["books"], s["wall"], s["cpu"], 1e3 * s["p50"], 1e3 * s["p95"], 1e3 * s["p99"]))
+    lines.append("")
+    lines.append("slowest books:")
+    for PG_id, seconds in summary["slowest"]:
+        lines.append("  %-10s %8.2f s" % (PG_id, seconds))
+    return "\n".join(lines)
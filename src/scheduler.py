@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+Process books on a pool of persistent workers, grouped by language.
+
+The sentence tokenizer is a different Punkt model for every language.
+Rather than sending books to whichever worker is free (so that every
+worker ends up loading every model), process_books_scheduled
+
+- assigns each language to one or more workers, in proportion to the
+  size of its books, and loads its model there when the worker starts,
+- sends each worker the books of its languages, largest first, so that
+  the longest books do not end up running alone at the end of the run,
+- once a worker has no books of its own languages left, gives it the
+  largest remaining book of the language with the most work left, which
+  it then keeps working on.
+
+Books larger than huge_size are processed first, one at a time, with
+the tokenization of their sentences split into chunks shared by all
+workers (see process_book's chunk_map); the output is the same. Only the
+word tokenization is spread: the reading, cleanup and sentence splitting
+of a huge book run serially in the main process, while the workers wait.
+
+Optionally, every book (or chunk of a huge book) is stopped after a
+timeout, and every worker is limited to an amount of memory; such books
+fail with a TimeoutError or MemoryError, and their partial output files
+are removed so that they are processed again on the next run. The same
+is done for the book of a worker that dies (e.g. killed for lack of
+memory). The reading and cleanup of huge books run in the main process,
+without timeout or memory limit.
+
+Like process_books in src.parallel, it yields one (job, stats, error) tuple
+per book, in the order books finish.
+"""
+import functools
+import multiprocessing
+import os
+import signal
+import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.connection import wait
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from .parallel import _process_job, _init_worker, executor_map
+from .tokenstream import tokens_path, sentences_path
+
+
+def _job_size(job):
+    """
+    Size of the raw file of a job, in bytes (0 if it does not exist).
+    """
+    try:
+        return os.path.getsize(job["path_to_raw_file"])
+    except OSError:
+        return 0
+
+
+def assign_languages(sizes, workers):
+    """
+    Split the languages among the workers.
+
+    Parameters
+    ----------
+    sizes : dict
+        Total size of the books of each language.
+    workers : int
+        Number of workers.
+
+    Returns
+    -------
+    list
+        For each worker, the list of its languages. With more workers
+        than languages, the largest languages get several workers; with
+        fewer, each language goes to the worker with the least work.
+    """
+    languages = sorted(sizes, key=lambda language: -sizes[language])
+    assigned = [[] for _ in range(workers)]
+    if len(languages) == 0:
+        return assigned
+    if workers >= len(languages):
+        n_workers = dict((language, 1) for language in languages)
+        for _ in range(workers - len(languages)):
+            # the language with the most work per worker gets one more
+            language = max(languages, key=lambda l: sizes[l] / n_workers[l])
+            n_workers[language] += 1
+        w = 0
+        for language in languages:
+            for _ in range(n_workers[language]):
+                assigned[w].append(language)
+                w += 1
+    else:
+        load = [0] * workers
+        for language in languages:
+            w = load.index(min(load))
+            assigned[w].append(language)
+            load[w] += sizes[language]
+    return assigned
+
+
+def _limit_memory(max_memory):
+    """
+    Limit the address space of the current process to max_memory bytes,
+    so that going over it raises a MemoryError.
+    """
+    if max_memory is not None and resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (max_memory, resource.getrlimit(resource.RLIMIT_AS)[1]))
+
+
+def _on_timeout(signum, frame):
+    raise TimeoutError("Timed out.")
+
+
+def _with_timeout(timeout, f, *args):
+    """
+    Call f(*args), raising a TimeoutError in it after timeout seconds.
+
+    Only available in the main thread, on systems with SIGALRM.
+    """
+    if timeout is None or not hasattr(signal, "SIGALRM"):
+        return f(*args)
+    previous = signal.signal(signal.SIGALRM, _on_timeout)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return f(*args)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def _remove_outputs(job):
+    """
+    Remove the output files of a book, e.g. partially written ones.
+    """
+    PG_number = job["path_to_raw_file"].split("/")[-1].split("_")[0][2:]
+    tokens_format = job.get("tokens_format", "text")
+    paths = [
+        os.path.join(job["text_dir"], "PG%s_text.txt" % PG_number),
+        tokens_path(job["tokens_dir"], PG_number, tokens_format),
+        os.path.join(job["counts_dir"], "PG%s_counts.txt" % PG_number)]
+    if tokens_format == "binary":
+        paths.append(sentences_path(job["tokens_dir"], PG_number))
+    for path in paths:
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def _run_job(job, timeout=None):
+    """
+    Process a job (see _process_job) within timeout seconds.
+    """
+    job, stats, error = _with_timeout(timeout, _process_job, job)
+    if error is not None and isinstance(error[0], (TimeoutError, MemoryError)):
+        _remove_outputs(job)
+    return job, stats, error
+
+
+def _run_huge_job(job, workers, timeout=None, max_memory=None, chunk_size=1000000):
+    """
+    Process a job in the current process, tokenizing its text in chunks
+    on a pool of workers.
+
+    Reading the raw file, the cleanup and the sentence splitting are done
+    here, serially, with all the workers idle until the first chunk of
+    sentences is ready, and without timeout or memory limit. A worker that
+    dies (e.g. killed for lack of memory) breaks the pool; the book then
+    fails with a BrokenProcessPool, and its partial outputs are removed.
+    """
+    with ProcessPoolExecutor(max_workers=workers, initializer=_limit_memory,
+                             initargs=(max_memory,)) as executor:
+        def chunk_map(f, chunks):
+            return executor_map(
+                executor, functools.partial(_with_timeout, timeout, f), chunks, 2 * workers)
+        job, stats, error = _process_job(dict(job, chunk_map=chunk_map, chunk_size=chunk_size))
+    job = dict((k, v) for k, v in job.items() if k not in ("chunk_map", "chunk_size"))
+    if error is not None and isinstance(error[0], (TimeoutError, MemoryError, BrokenProcessPool)):
+        _remove_outputs(job)
+    return job, stats, error
+
+
+def _worker_main(conn, languages, timeout=None, max_memory=None):
+    """
+    Process the jobs received on conn until None is received.
+    """
+    _init_worker(languages)
+    _limit_memory(max_memory)
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        _, stats, error = _run_job(job, timeout)
+        try:
+            conn.send((stats, error))
+        except Exception as e:
+            # e.g. the stats or the exception can not be pickled
+            if error is None:
+                error = (e, traceback.format_exc())
+            conn.send((None, (RuntimeError(repr(error[0])), error[1])))
+
+
+class _Worker(object):
+
+    def __init__(self, context, languages, timeout=None, max_memory=None):
+        self.languages = list(languages)
+        self.limits = (timeout, max_memory)
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main, args=(child_conn, self.languages) + self.limits,
+            daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.job = None  # the job being processed
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+
+
+def process_books_scheduled(jobs, workers=None, timeout=None, max_memory=None,
+                            huge_size=None, chunk_size=1000000):
+    """
+    Process jobs on a pool of worker processes, with every language
+    handled by the workers that hold its tokenizer.
+
+    Parameters
+    ----------
+    jobs : list
+        Keyword arguments for process_book, one dict per book.
+    workers : int
+        Number of worker processes. Defaults to the number of CPUs.
+    timeout : float
+        Maximum time to process a book (or a chunk of a huge book), in
+        seconds. No limit if None.
+    max_memory : int
+        Maximum memory (address space) of each worker, in bytes. No limit
+        if None.
+    huge_size : int
+        Books whose raw file is at least this large, in bytes, are
+        tokenized in chunks of chunk_size characters by all workers.
+        Disabled if None.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    sized = [(_job_size(job), job) for job in jobs]
+    sized.sort(key=lambda x: -x[0])
+
+    # the huge books first, each one on all workers
+    while len(sized) > 0 and huge_size is not None and sized[0][0] >= huge_size:
+        _, job = sized.pop(0)
+        yield _run_huge_job(job, workers, timeout, max_memory, chunk_size)
+
+    # the others grouped by language, largest first
+    queues, remaining = {}, {}
+    for size, job in sized:
+        language = job.get("language", "english")
+        queues.setdefault(language, deque()).append((size, job))
+        remaining[language] = remaining.get(language, 0) + size
+    if len(sized) == 0:
+        return
+    workers = max(1, min(workers, len(sized)))
+
+    def next_job(worker):
+        own = [l for l in worker.languages if len(queues[l]) > 0]
+        if len(own) == 0:
+            # nothing left in its languages: help with the biggest backlog
+            others = [l for l in queues if len(queues[l]) > 0]
+            if len(others) == 0:
+                return None
+            language = max(others, key=lambda l: remaining[l])
+            worker.languages.append(language)
+        else:
+            language = max(own, key=lambda l: queues[l][0][0])
+        size, job = queues[language].popleft()
+        remaining[language] -= size
+        return job
+
+    context = multiprocessing.get_context()
+    pool = [_Worker(context, languages, timeout, max_memory)
+            for languages in assign_languages(remaining, workers)]
+
+    def feed(i):
+        # send the worker its next job, if any
+        job = next_job(pool[i])
+        pool[i].job = job
+        if job is not None:
+            try:
+                pool[i].conn.send(job)
+            except OSError:
+                # the worker died while idle: replace it
+                pool[i] = replace(pool[i])
+                pool[i].job = job
+                pool[i].conn.send(job)
+
+    def replace(worker):
+        worker.stop()
+        return _Worker(context, worker.languages, *worker.limits)
+
+    try:
+        for i in range(len(pool)):
+            feed(i)
+        while True:
+            busy = [i for i, worker in enumerate(pool) if worker.job is not None]
+            if len(busy) == 0:
+                break
+            ready = wait([pool[i].conn for i in busy] + [pool[i].process.sentinel for i in busy])
+            for i in busy:
+                worker = pool[i]
+                if worker.conn not in ready and worker.process.sentinel not in ready:
+                    continue
+                job = worker.job
+                try:
+                    if not worker.conn.poll():
+                        raise EOFError
+                    stats, error = worker.conn.recv()
+                except (EOFError, OSError):
+                    # the worker died while processing the job: its
+                    # output files may be incomplete
+                    worker.process.join(timeout=1)
+                    exitcode = worker.process.exitcode
+                    pool[i] = replace(worker)
+                    _remove_outputs(job)
+                    e = RuntimeError("Worker process died (exit code %s)." % exitcode)
+                    yield job, None, (e, "")
+                    feed(i)
+                    continue
+                yield job, stats, error
+                feed(i)
+    finally:
+        for worker in pool:
+            worker.stop()
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+Selection of the books to download and process, by PG id.
+
+A selection is a set of ids (ranges like 10000-10134, single ids, or the
+ids listed in a file) and, optionally, a shard i/N: the books are split
+into N shards by a hash of their id, and only the i-th (counting from 0)
+is kept. The hash only depends on the id, so running with --shard 0/N,
+..., --shard N-1/N on N machines downloads and processes every book of
+the selection exactly once.
+
+get_data.py and process_data.py (and their _validation variants) take the
+same --ids and --shard arguments, see add_selection_arguments.
+
+For the download, rsync only matches the book files of the mirror against a
+single pattern, whatever the selection: the list of the book files is
+fetched first, the files of the selected books are picked from it here, and
+only those are transferred (see download_selection).
+"""
+import bisect
+import fnmatch
+import os
+import re
+import subprocess
+import tempfile
+import zlib
+
+## the rsync module of the mirror
+MIRROR = "aleph.gutenberg.org::gutenberg"
+## rsync pattern of the book files of the mirror, e.g. pg12345.txt.utf8
+BOOK_PATTERN = "pg[1-9]*[.-][t0][x.]t[x.]*[t8]"
+
+
+def parse_ids(spec):
+    """
+    Parse a specification of PG ids.
+
+    Parameters
+    ----------
+    spec : str
+        Comma-separated ids and inclusive ranges, e.g. "10000-10134,10200".
+        A range can be open ("60000-"), "" or "all" selects all ids, and
+        "@path" reads the specification from a file (ids and ranges
+        separated by commas, spaces or new lines; "PG" prefixes allowed).
+
+    Returns
+    -------
+    list of (int, int or None)
+        Sorted, disjoint inclusive ranges; None is an open end. None if
+        all ids are selected.
+    """
+    spec = spec.strip()
+    if spec.startswith("@"):
+        with open(spec[1:]) as f:
+            spec = ",".join(f.read().split())
+    if spec in ("", "all"):
+        return None
+    ranges = []
+    for item in spec.split(","):
+        item = item.strip().replace("PG", "")
+        if item == "":
+            continue
+        try:
+            if "-" in item:
+                lo, hi = item.split("-")
+                ranges.append((int(lo), int(hi) if hi != "" else None))
+            else:
+                ranges.append((int(item), int(item)))
+        except ValueError:
+            raise ValueError("Invalid PG id or range '%s'" % item)
+    # merge overlapping and adjacent ranges
+    ranges.sort(key=lambda r: r[0])
+    merged = []
+    for lo, hi in ranges:
+        if hi is not None and hi < lo:
+            raise ValueError("Invalid PG id range %d-%d" % (lo, hi))
+        if len(merged) > 0 and (merged[-1][1] is None or lo <= merged[-1][1] + 1):
+            if merged[-1][1] is not None:
+                merged[-1] = (merged[-1][0], None if hi is None else max(hi, merged[-1][1]))
+        else:
+            merged.append((lo, hi))
+    return merged
+
+
+def parse_shard(spec):
+    """
+    Parse a shard "i/N" into (i, N), with 0 <= i < N. "" is (0, 1).
+    """
+    if spec.strip() == "":
+        return 0, 1
+    try:
+        i, n = [int(x) for x in spec.split("/")]
+    except ValueError:
+        raise ValueError("Invalid shard '%s', expected i/N" % spec)
+    if not 0 <= i < n:
+        raise ValueError("Invalid shard '%s', expected 0 <= i < N" % spec)
+    return i, n
+
+
+def shard_of(PG_number, n_shards):
+    """
+    Shard of a book among n_shards, from the CRC-32 of its PG number (so it
+    is the same on every machine and every run).
+    """
+    return zlib.crc32(str(PG_number).encode("ascii")) % n_shards
+
+
+class BookSelection(object):
+
+    def __init__(self, ids="", shard=""):
+        '''Books whose id is in ids and that belong to the shard (see
+        parse_ids and parse_shard for the specifications).
+        '''
+        self.ranges = parse_ids(ids)
+        self.shard, self.n_shards = parse_shard(shard)
+        self._starts = [lo for lo, _ in self.ranges] if self.ranges is not None else None
+
+    def __contains__(self, PG_id):
+        '''Whether a book is selected; PG_id is an int or a string like
+        "12345" or "PG12345".
+        '''
+        if isinstance(PG_id, str):
+            PG_id = PG_id[2:] if PG_id.startswith("PG") else PG_id
+            if not PG_id.isdigit():
+                return False
+            PG_id = int(PG_id)
+        if self.ranges is not None:
+            k = bisect.bisect_right(self._starts, PG_id) - 1
+            if k < 0:
+                return False
+            hi = self.ranges[k][1]
+            if hi is not None and PG_id > hi:
+                return False
+        return self.n_shards == 1 or shard_of(PG_id, self.n_shards) == self.shard
+
+    def __repr__(self):
+        ranges = "all" if self.ranges is None else ",".join(
+            "%d" % lo if lo == hi else "%d-%s" % (lo, "" if hi is None else hi)
+            for lo, hi in self.ranges)
+        return "BookSelection(ids=%s, shard=%d/%d)" % (ranges, self.shard, self.n_shards)
+
+    def select_files(self, paths):
+        '''The paths of the book files (pg12345.txt.utf8, ...) of the
+        selected books.
+        '''
+        selected = []
+        for path in paths:
+            m = re.match(r"pg([0-9]+)", os.path.basename(path))
+            if m is not None and int(m.group(1)) in self:
+                selected.append(path)
+        return selected
+
+
+def list_mirror_files(mirror=MIRROR):
+    '''The paths of all the book files of the mirror (matching
+    BOOK_PATTERN), relative to the rsync module, from rsync --list-only.
+    None if rsync fails.
+    '''
+    sp_args = ["rsync", "-rm", "--list-only",
+               "--include", "*/", "--include", BOOK_PATTERN, "--exclude", "*",
+               mirror]
+    try:
+        listing = subprocess.run(sp_args, stdout=subprocess.PIPE, universal_newlines=True)
+    except OSError:
+        return None
+    if listing.returncode != 0:
+        return None
+    paths = []
+    for line in listing.stdout.splitlines():
+        # e.g. "-rw-r--r--  123,456 2020/01/01 12:00:00 1/0/0/0/10000/pg10000.txt.utf8"
+        fields = line.split(None, 4)
+        if len(fields) == 5 and line.startswith("-"):
+            paths.append(fields[4])
+    return paths
+
+
+def prune_mirror(mirror_dir, keep):
+    '''Remove the book files of the local mirror that are not in keep
+    (paths relative to mirror_dir), as rsync --delete-excluded would.
+    Returns the number of files removed.
+    '''
+    keep = set(keep)
+    removed = 0
+    for root, dirs, files in os.walk(mirror_dir):
+        for name in files:
+            if not fnmatch.fnmatchcase(name, BOOK_PATTERN):
+                continue
+            path = os.path.join(root, name)
+            if os.path.relpath(path, mirror_dir).replace(os.sep, "/") not in keep:
+                os.remove(path)
+                removed += 1
+    return removed
+
+
+def download_selection(selection, mirror_dir, mirror=MIRROR, quiet=False):
+    '''Update the local mirror with the book files of the selected books.
+
+    The book files of the remote mirror are listed with a single rsync
+    pattern and selected here, and exactly the selected files are
+    transferred (rsync --files-from), so the cost of the filter does not
+    grow with the number of selected books. Book files of the local mirror
+    that are no longer selected (or no longer in the remote mirror) are
+    removed. If the mirror can not be listed, nothing is changed.
+
+    Returns the number of selected files, or None if the listing failed.
+    '''
+    paths = list_mirror_files(mirror)
+    if paths is None:
+        if not quiet:
+            print("Could not list the files of %s, the mirror is not updated." % mirror)
+        return None
+    selected = selection.select_files(paths)
+    with tempfile.NamedTemporaryFile("w", suffix=".rsync") as files_from:
+        files_from.write("".join(path + "\n" for path in selected))
+        files_from.flush()
+        sp_args = ["rsync", "-am%s" % ("" if quiet else "v"),
+                   "--files-from", files_from.name, mirror, mirror_dir]
+        subprocess.call(sp_args)
+    removed = prune_mirror(mirror_dir, selected)
+    if not quiet:
+        print("mirror: %d book files selected, %d removed" % (len(selected), removed))
+    return len(selected)
+
+
+def add_selection_arguments(parser, ids=""):
+    '''Add the --ids and --shard arguments to an argparse parser, with ids
+    as the default --ids.
+    '''
+    parser.add_argument(
+        "-i", "--ids",
+        help="PG ids of the books, as ids and inclusive ranges, e.g. "
+             "'10000-10134,10200', 'all', or '@file' to read them from a file",
+        default=ids,
+        type=str)
+    parser.add_argument(
+        "-s", "--shard",
+        help="Only the i-th of N shards of the books, as i/N (0 <= i < N); "
+             "the shard of a book only depends on its id",
+        default="",
+        type=str)
+
+
+def selection_from_args(args):
+    '''The BookSelection of the --ids and --shard arguments.
+    '''
+    return BookSelection(ids=args.ids, shard=args.shard)
@@ -4,17 +4,110 @@
    You will get a list of tokens
 """
 
+import os
+import pickle
+import re
+import time
+
 import nltk
 nltk.data.path=["src/nltk_data"]
 
 from nltk.tokenize.treebank import TreebankWordTokenizer
-from nltk.tokenize import sent_tokenize
+try:
+    ## nltk >= 3.9 reads the Punkt parameters from punkt_tab
+    from nltk.tokenize.punkt import PunktTokenizer
+except ImportError:
+    PunktTokenizer = None
+
+## the Punkt models bundled with the repository
+PUNKT_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "nltk_data", "tokenizers", "punkt", "PY3")
+
+## tokenizers loaded so far in this process
+_sentence_tokenizers = {}
+_word_tokenizer = None
+_cache_stats = {"hits": 0, "misses": 0, "load_time": 0.0}
+
+
+def _load_sentence_tokenizer(language):
+    '''Load the Punkt sentence tokenizer for a language.
+    Uses punkt_tab if it is installed (as sent_tokenize does),
+    otherwise the pickled model bundled in src/nltk_data.
+    '''
+    if PunktTokenizer is not None:
+        try:
+            return PunktTokenizer(language)
+        except LookupError:
+            pass
+    path = os.path.join(PUNKT_DIR, "%s.pickle" % language)
+    if not os.path.isfile(path):
+        raise LookupError("No Punkt model found for language '%s'" % language)
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def get_sentence_tokenizer(language="english"):
+    '''Return the Punkt sentence tokenizer for a language.
+    The model is loaded only the first time it is requested in a process.
+    '''
+    tokenizer = _sentence_tokenizers.get(language)
+    if tokenizer is None:
+        _cache_stats["misses"] += 1
+        t0 = time.perf_counter()
+        tokenizer = _load_sentence_tokenizer(language)
+        _cache_stats["load_time"] += time.perf_counter() - t0
+        _sentence_tokenizers[language] = tokenizer
+    else:
+        _cache_stats["hits"] += 1
+    return tokenizer
+
+
+def get_word_tokenizer():
+    '''Return the (shared) Treebank word tokenizer.
+    '''
+    global _word_tokenizer
+    if _word_tokenizer is None:
+        _word_tokenizer = TreebankWordTokenizer()
+    return _word_tokenizer
+
+
+def warm_tokenizers(languages=("english",)):
+    '''Load the tokenizers for the given languages.
+    Meant to be called when a worker process starts, so that
+    processing the first book does not pay for loading the models.
+    '''
+    get_word_tokenizer()
+    for language in languages:
+        get_sentence_tokenizer(language)
+
+
+def tokenizer_cache_stats():
+    '''Statistics of the tokenizer cache of this process.
+    OUT:
+    - dict with the number of cache hits and misses, the languages
+      loaded and the total time (in seconds) spent loading models
+    '''
+    stats = dict(_cache_stats)
+    stats["languages"] = sorted(_sentence_tokenizers)
+    return stats
+
+
+def clear_tokenizer_cache():
+    '''Forget all loaded tokenizers and reset the statistics.
+    '''
+    global _word_tokenizer
+    _sentence_tokenizers.clear()
+    _word_tokenizer = None
+    clear_piece_cache()
+    _cache_stats.update(hits=0, misses=0, load_time=0.0)
 
 
 def tokenize_text(text, language="english"):
     '''Tokenize a string into a list of tokens.
     Use NLTK's Treebankwordtokenizer.
-    Note that we first split into sentences using NLTK's sent_tokenize.
+    Note that we first split into sentences using NLTK's Punkt tokenizer
+    (as nltk's sent_tokenize does).
     We additionally call a filtering function to remove un-wanted tokens.
     
     IN:
@@ -24,26 +117,217 @@ def tokenize_text(text, language="english"):
     '''
     ## list of tokens
     list_tokens = []
-    
-    ## split text into sentences
-    sentences=sent_tokenize(text, language=language)
-    
-    ## define the tokenizer
-    tokenizer = TreebankWordTokenizer()
-    ## loop over all sentences
-    for sent in sentences:
-        ## tokenize the sentence
-        sent_tokenized = tokenizer.tokenize(sent)
-        ## lowercase the tokens
+    for sent_tokenized in iter_tokenize_text(text, language=language):
         ## add tokens to list of tokens
         list_tokens += sent_tokenized
-    list_tokens = filter_tokens(list_tokens)
     return list_tokens
 
+def iter_tokenize_text(text, language="english"):
+    '''Tokenize a string, one sentence at a time.
+    Gives the same tokens as tokenize_text, but only one sentence
+    is tokenized (and kept in memory) at a time.
+
+    IN:
+    - text, str
+    OUT:
+    - iterator over lists of strings, the (filtered) tokens of each sentence
+    '''
+    ## define the tokenizers
+    sentence_tokenizer = get_sentence_tokenizer(language)
+    tokenizer = get_word_tokenizer()
+    ## loop over all sentences, as they are found
+    for start, end in sentence_tokenizer.span_tokenize(text):
+        ## tokenize the sentence
+        sent_tokenized = tokenizer.tokenize(text[start:end])
+        ## lowercase and filter the tokens
+        yield filter_tokens(sent_tokenized)
+
+def iter_tokenize_chunks(text, language="english", map_f=map, chunk_size=1000000,
+                         tokenize_chunk_f=None):
+    '''Tokenize a string in chunks of sentences, e.g. on several processes.
+    Gives the same sentences as iter_tokenize_text: the text is split into
+    sentences first, and only the tokenization of the sentences is spread
+    over the chunks.
+    A chunk ends with the first paragraph (a sentence followed by an empty
+    line) that brings it to chunk_size characters, or at the first sentence
+    once it reaches twice that size.
+
+    IN:
+    - text, str
+    - map_f, function with the signature of map, e.g. src.parallel.parallel_map
+    - tokenize_chunk_f, function tokenizing a list of sentences,
+      tokenize_sentences (default) or tokenize_sentences_fast
+    OUT:
+    - iterator over lists of strings, the (filtered) tokens of each sentence
+    '''
+    if tokenize_chunk_f is None:
+        tokenize_chunk_f = tokenize_sentences
+    def chunks():
+        chunk, chunk_start, prev_end = [], 0, 0
+        for start, end in get_sentence_tokenizer(language).span_tokenize(text):
+            size = prev_end - chunk_start
+            if len(chunk) > 0 and size >= chunk_size and \
+                    (text.count("\n", prev_end, start) >= 2 or size >= 2 * chunk_size):
+                yield chunk
+                chunk = []
+            if len(chunk) == 0:
+                chunk_start = start
+            chunk.append(text[start:end])
+            prev_end = end
+        if len(chunk) > 0:
+            yield chunk
+    for chunk_tokenized in map_f(tokenize_chunk_f, chunks()):
+        for sent_tokenized in chunk_tokenized:
+            yield sent_tokenized
+
+def tokenize_sentences(sentences):
+    '''Tokenize a list of sentences, as iter_tokenize_text does.
+
+    IN:
+    - sentences, list of str
+    OUT:
+    - list of lists of strings, the (filtered) tokens of each sentence
+    '''
+    tokenizer = get_word_tokenizer()
+    return [filter_tokens(tokenizer.tokenize(sent)) for sent in sentences]
+
 def filter_tokens(list_tokens):
     '''Remove un-wanted tokens from list of tokens
     We only keep words that return TRUE for string.isaplha()
     We lowercase every token with string.lower()
     '''
     list_tokens_filter = [h.lower() for h in list_tokens if h.isalpha()]
-    return list_tokens_filter
\ No newline at end of file
+    return list_tokens_filter
+
+################
+## Fast path: the same tokens as the Treebank tokenizer and filter_tokens,
+## with the tokenization of each piece of text between two spaces done once
+## per process.
+##
+## No rule of the Treebank tokenizer matches across whitespace (they look
+## at most at the whitespace character next to a word), the ^ and $ rules
+## aside, and rules only ever add spaces. A sentence split at its spaces
+## hence gives the same tokens piece by piece, as long as each piece keeps
+## its context:
+## - an inner piece has a space on both sides,
+## - the first piece starts the sentence (^ rules),
+## - the last piece, with the trailing whitespace, ends it ($ rules).
+## The filtered tokens of each piece are cached, and the pieces missing
+## from the cache are tokenized together in a single call, separated by
+## _SEPARATOR (a private use character no rule touches). Sentences that
+## contain it are tokenized as a whole.
+
+_SEPARATOR = "\ue000"
+## filtered tokens of the first, inner and last pieces of sentences
+_first_pieces = {}
+_inner_pieces = {}
+_last_pieces = {}
+## the caches are emptied when they reach this number of inner pieces
+PIECE_CACHE_SIZE = 200000
+
+
+def clear_piece_cache():
+    '''Forget the tokens of all pieces (see tokenize_sentence_fast).
+    '''
+    _first_pieces.clear()
+    _inner_pieces.clear()
+    _last_pieces.clear()
+
+
+def _is_contraction(word):
+    '''Whether the Treebank tokenizer splits an alphabetic word
+    (cannot, gimme, gonna, gotta, lemme, wanna, in any case).
+    '''
+    padded = " %s " % word
+    return any(regexp.search(padded) for regexp in TreebankWordTokenizer.CONTRACTIONS2)
+
+
+def _tokenize_pieces(first, inner, last):
+    '''Tokenize the pieces of a sentence and add them to the caches.
+    IN:
+    - first, last, str: the first and last pieces
+    - inner, list of str: inner pieces
+    '''
+    batch = []
+    for piece in inner:
+        ## most words need no tokenizer at all
+        if piece.isalpha() and not _is_contraction(piece):
+            _inner_pieces[piece] = [piece.lower()]
+        else:
+            batch.append(piece)
+    sep = " %s " % _SEPARATOR
+    tokens = get_word_tokenizer().tokenize(first + sep + sep.join(batch + [last]))
+    groups, group = [], []
+    for token in tokens:
+        if token == _SEPARATOR:
+            groups.append(group)
+            group = []
+        else:
+            group.append(token)
+    groups.append(group)
+    _first_pieces[first] = filter_tokens(groups[0])
+    for piece, group in zip(batch, groups[1:-1]):
+        _inner_pieces[piece] = filter_tokens(group)
+    _last_pieces[last] = filter_tokens(groups[-1])
+
+
+def tokenize_sentence_fast(sentence):
+    '''Tokenize a sentence with the Treebank tokenizer and filter the
+    tokens, as iter_tokenize_text does, using the caches of pieces.
+
+    IN:
+    - sentence, str
+    OUT:
+    - list of strings, the (filtered) tokens
+    '''
+    core = sentence.rstrip()
+    pieces = core.split(" ")
+    if len(pieces) == 1 or _SEPARATOR in sentence:
+        return filter_tokens(get_word_tokenizer().tokenize(sentence))
+    first, last = pieces[0], pieces[-1] + sentence[len(core):]
+    inner = pieces[1:-1]
+    ## emptied before looking up the pieces, so that the ones found stay
+    if len(_inner_pieces) >= PIECE_CACHE_SIZE:
+        clear_piece_cache()
+    missing = [piece for piece in inner if piece not in _inner_pieces]
+    if len(missing) > 0 or first not in _first_pieces or last not in _last_pieces:
+        _tokenize_pieces(first, missing, last)
+    list_tokens = list(_first_pieces[first])
+    for piece in inner:
+        list_tokens += _inner_pieces[piece]
+    list_tokens += _last_pieces[last]
+    return list_tokens
+
+
+def iter_tokenize_text_fast(text, language="english"):
+    '''Same as iter_tokenize_text, with tokenize_sentence_fast.
+    '''
+    sentence_tokenizer = get_sentence_tokenizer(language)
+    for start, end in sentence_tokenizer.span_tokenize(text):
+        yield tokenize_sentence_fast(text[start:end])
+
+def iter_tokenize_chunks_fast(text, language="english", map_f=map, chunk_size=1000000):
+    '''Same as iter_tokenize_chunks, with tokenize_sentence_fast.
+    '''
+    return iter_tokenize_chunks(text, language=language, map_f=map_f, chunk_size=chunk_size,
+                                tokenize_chunk_f=tokenize_sentences_fast)
+
+def tokenize_sentences_fast(sentences):
+    '''Same as tokenize_sentences, with tokenize_sentence_fast.
+    '''
+    return [tokenize_sentence_fast(sent) for sent in sentences]
+
+def tokenize_text_fast(text, language="english"):
+    '''Tokenize a string into a list of tokens.
+    Gives exactly the tokens of tokenize_text, faster (see
+    tokenize_sentence_fast).
+    '''
+    list_tokens = []
+    for sent_tokenized in iter_tokenize_text_fast(text, language=language):
+        list_tokens += sent_tokenized
+    return list_tokens
+
+## Bump whenever a change to the tokenizer changes its output, so that
+## incremental runs know the tokens and counts must be recomputed.
+tokenize_text.version = 1
+tokenize_text_fast.version = 1
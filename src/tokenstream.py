@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Writers and readers for the tokens files.
+
+Two formats are supported:
+
+- text: PG*_tokens.txt, one token per line (the default).
+- binary: PG*_tokens.npy, the tokens as a uint32 array of ids in a
+  corpus-wide vocabulary (see src.vocabulary), and PG*_sentences.npy,
+  a uint64 array with the end position of each sentence in the tokens
+  array. Both can be memory-mapped with numpy.load(..., mmap_mode="r").
+"""
+import io
+import os
+
+import numpy as np
+
+from .vocabulary import get_vocabulary
+
+TOKENS_FORMATS = ("text", "binary")
+
+
+def tokens_path(tokens_dir, PG_number, tokens_format="text"):
+    """
+    Path of the tokens file of a book in the given format.
+    """
+    if tokens_format == "text":
+        return os.path.join(tokens_dir, "PG%s_tokens.txt" % PG_number)
+    elif tokens_format == "binary":
+        return os.path.join(tokens_dir, "PG%s_tokens.npy" % PG_number)
+    raise ValueError("Unknown tokens format '%s'." % tokens_format)
+
+
+def sentences_path(tokens_dir, PG_number):
+    """
+    Path of the sentence boundaries of a book in the binary format.
+    """
+    return os.path.join(tokens_dir, "PG%s_sentences.npy" % PG_number)
+
+
+def default_vocabulary_file(tokens_dir):
+    """
+    Vocabulary used for binary tokens if none is given.
+    """
+    return os.path.join(tokens_dir, "vocab.txt")
+
+
+class TextTokensWriter(object):
+    """
+    Write tokens to PG*_tokens.txt, one token per line.
+    """
+
+    def __init__(self, tokens_dir, PG_number):
+        self.f = io.open(tokens_path(tokens_dir, PG_number, "text"), "w", encoding="UTF-8")
+        self.n_tokens = 0
+
+    def write_sentence(self, tokens):
+        if len(tokens) > 0:
+            self.f.write("\n".join(tokens) + "\n")
+            self.n_tokens += len(tokens)
+
+    def close(self):
+        # an empty book has a single empty line
+        if self.n_tokens == 0:
+            self.f.write("\n")
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class BinaryTokensWriter(object):
+    """
+    Write tokens as arrays of vocabulary ids and sentence boundaries.
+
+    Only the ids (4 bytes per token) are kept in memory until the book is
+    closed.
+    """
+
+    def __init__(self, tokens_dir, PG_number, vocabulary_file=None):
+        if vocabulary_file is None:
+            vocabulary_file = default_vocabulary_file(tokens_dir)
+        self.vocabulary = get_vocabulary(vocabulary_file)
+        self.tokens_file = tokens_path(tokens_dir, PG_number, "binary")
+        self.sentences_file = sentences_path(tokens_dir, PG_number)
+        self.ids = []
+        self.sentence_ends = []
+        self.n_tokens = 0
+
+    def write_sentence(self, tokens):
+        if len(tokens) > 0:
+            self.ids.append(self.vocabulary.lookup(tokens))
+            self.n_tokens += len(tokens)
+            self.sentence_ends.append(self.n_tokens)
+
+    def close(self):
+        ids = np.concatenate(self.ids) if len(self.ids) > 0 else np.zeros(0, dtype=np.uint32)
+        np.save(self.sentences_file, np.array(self.sentence_ends, dtype=np.uint64))
+        np.save(self.tokens_file, ids)
+        self.ids = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_tokens_writer(tokens_dir, PG_number, tokens_format="text", vocabulary_file=None):
+    """
+    Writer for the tokens of a book, used as a context manager.
+
+    Tokens are passed one sentence at a time to its write_sentence method.
+    """
+    if tokens_format == "text":
+        return TextTokensWriter(tokens_dir, PG_number)
+    elif tokens_format == "binary":
+        return BinaryTokensWriter(tokens_dir, PG_number, vocabulary_file=vocabulary_file)
+    raise ValueError("Unknown tokens format '%s'." % tokens_format)
+
+
+def load_tokens(tokens_dir, PG_id):
+    """
+    Memory-map the binary tokens of a book.
+
+    Parameters
+    ----------
+    PG_id : str
+        PG id of the book, e.g. 'PG12345'.
+
+    Returns
+    -------
+    (numpy.memmap, numpy.memmap)
+        The token ids and the end position of each sentence.
+    """
+    PG_number = PG_id[2:] if PG_id.startswith("PG") else PG_id
+    ids = np.load(tokens_path(tokens_dir, PG_number, "binary"), mmap_mode="r")
+    sentence_ends = np.load(sentences_path(tokens_dir, PG_number), mmap_mode="r")
+    return ids, sentence_ends
+
+
+def iter_sentences(ids, sentence_ends):
+    """
+    Split the token ids of a book into sentences (views, not copies).
+    """
+    start = 0
+    for end in sentence_ends:
+        yield ids[start:end]
+        start = end
+
+
+def convert_tokens_file(path_to_tokens_file, tokens_dir, vocabulary_file=None):
+    """
+    Convert a PG*_tokens.txt file to the binary format.
+
+    Text tokens files do not keep sentence boundaries, so the whole book
+    is stored as a single sentence.
+    """
+    PG_number = os.path.basename(path_to_tokens_file).split("_")[0][2:]
+    with io.open(path_to_tokens_file, encoding="UTF-8") as f:
+        tokens = [line.rstrip("\n") for line in f if line != "\n"]
+    with BinaryTokensWriter(tokens_dir, PG_number, vocabulary_file=vocabulary_file) as writer:
+        writer.write_sentence(tokens)
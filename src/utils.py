@@ -3,6 +3,8 @@ import os
 import shutil
 import subprocess
 import glob
+import fnmatch
+from concurrent.futures import ThreadPoolExecutor
 
 def get_langs_dict():
     """
@@ -50,6 +52,7 @@ def get_PG_number(string):
 
 def list_duplicates_in_mirror(
     mirror_dir = None,
+    index = None,
     ):
     """
     Look for duplicates in 'mirror_dir', and list them.
@@ -60,29 +63,122 @@ def list_duplicates_in_mirror(
     2) mirror/cache/epub/12345/pg12345.txt.utf-8
 
     We populate 1) and list 2) as a duplicate
+
+    Parameters
+    ----------
+    index : MirrorIndex
+        An index of the mirror (see src.mirrorindex), so that the mirror
+        is not traversed again. Built if None.
+    """
+    if index is None:
+        from .mirrorindex import MirrorIndex
+        index = MirrorIndex(mirror_dir)
+    return index.duplicates()
+
+
+def _iter_files(top):
+    """
+    Iterate over the (path, name) of all files in top and its
+    subdirectories, in a single scandir pass. Like os.walk, symlinks to
+    directories are not followed and unreadable directories are skipped.
+    """
+    stack = [top]
+    while len(stack) > 0:
+        dir_path = stack.pop()
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file():
+                            yield entry.path, entry.name
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+
+
+def _raw_PG_number(fname):
+    """
+    The PG number of a book file of the mirror (12345-0.txt or
+    pg12345.txt.utf8), or None for any other file.
+    """
+    if not fnmatch.fnmatchcase(fname, "[p123456789][g0123456789][0-9]*"):
+        return None
+    # avoid files with more "." or "-" than expected
+    if (len(fname.split("."))==2 and len(fname.split("-"))==2 and fname[-6::]=="-0.txt")\
+    or (len(fname.split("."))==3 and len(fname.split("-"))==1 and fname[-9::]==".txt.utf8"):
+        return get_PG_number(fname)
+    return None
+
+
+def _link(source, target):
+    """
+    Hard link source to target, replacing target (as ln -f does).
+    Returns None, or the error.
+    """
+    try:
+        try:
+            os.link(source, target)
+        except FileExistsError:
+            os.remove(target)
+            os.link(source, target)
+    except OSError as e:
+        return e
+    return None
+
+
+def select_mirror_files(files, dups_list=None, quiet=False):
     """
-    dups_list = []
-    for dirName, subdirList, fileList in os.walk(mirror_dir):
-        for matchpath in glob.iglob(os.path.join(dirName,"*-0.txt")):
-            fname = matchpath.split("/")[-1]
-            # fname must have exactly one "." and one "-"
-            if (len(fname.split("."))==2 and len(fname.split("-"))==2):
-                PGnumber = get_PG_number(fname)
-                possible_duplicate = os.path.join(mirror_dir,"cache","epub",PGnumber,"pg"+PGnumber+".txt.utf8")
-                if os.path.isfile(possible_duplicate):
-                    dups_list.append(possible_duplicate)
-    return dups_list
+    Pick the file of every book among the files of the mirror.
+
+    Parameters
+    ----------
+    files : iterable
+        (path, name) of the files, e.g. MirrorIndex.iter_files().
+    dups_list :  list of strings
+        A list of duplicates produced by list_duplicates_in_mirror.
+
+    Returns
+    -------
+    dict, int
+        PG number --> path of the first file of the book that is not in
+        dups_list, and the number of duplicates (the files in dups_list,
+        and the other files of the same book).
+    """
+    dups = set(dups_list) if dups_list is not None else set()
+    sources = {}
+    n_duplicates = 0
+    for source, fname in files:
+        PGnumber = _raw_PG_number(fname)
+        if PGnumber is None:
+            continue
+        if source in dups:
+            n_duplicates += 1
+            if not quiet:
+                print("# WARNING: file %s skipped due to duplication" % fname)
+        elif PGnumber in sources:
+            n_duplicates += 1
+            if not quiet:
+                print("# WARNING: file %s skipped, PG%s already linked from %s" % (
+                    fname, PGnumber, sources[PGnumber]))
+        else:
+            sources[PGnumber] = source
+    return sources, n_duplicates
 
 
 def populate_raw_from_mirror(mirror_dir=None,
                              raw_dir=None,
                              overwrite=False,
                              dups_list=None,
-                             quiet=False):
+                             quiet=False,
+                             workers=1,
+                             index=None):
     """
     Populate the raw/ directory using the .mirror/ directory.
 
-    This function traverses 'mirror_dir' and copies all .txt files
+    This function traverses 'mirror_dir' and hard links all .txt files
     into 'raw_dir'. Notice it also adds the "PG" suffix.
 
     It ignores files with more than one dash (strange files)
@@ -95,29 +191,139 @@ def populate_raw_from_mirror(mirror_dir=None,
     dups_list :  list of strings
         A list of duplicates produced by list_duplicates_in_mirror.
         Files in this list are not copied into raw.
+    workers : int
+        Number of threads creating the links.
+    index : MirrorIndex
+        An index of the mirror (see src.mirrorindex), used instead of
+        traversing the mirror.
+
+    Returns
+    -------
+    dict
+        Number of files linked, skipped (already in raw), duplicates (in
+        dups_list, or a second file of the same book) and failed (could
+        not be linked).
 
     """
-    for dirName, subdirList, fileList in os.walk(mirror_dir):
-        # patterns to match are 12345-0.txt or pg12345.txt.utf8
-        for matchpath in glob.iglob(os.path.join(dirName, "[p123456789][g0123456789][0-9]*")):
-            fname = matchpath.split("/")[-1]
-            # check that file is not in dups_list
-            if matchpath not in dups_list:
-                # avoid files with more "." or "-" than expected
-                if (len(fname.split("."))==2 and len(fname.split("-"))==2 and fname[-6::]=="-0.txt")\
-                or (len(fname.split("."))==3 and len(fname.split("-"))==1 and fname[-9::]==".txt.utf8"):
-                    # get PG number
-                    PGnumber = get_PG_number(fname)
+    # a single pass over the mirror, keeping the first file of every book
+    files = index.iter_files() if index is not None else _iter_files(mirror_dir)
+    sources, n_duplicates = select_mirror_files(files, dups_list=dups_list, quiet=quiet)
+    counts = link_raw_files(sources, raw_dir, overwrite=overwrite, quiet=quiet, workers=workers)
+    counts["duplicates"] = n_duplicates
+    return counts
 
-                    source = os.path.join(dirName, fname)
-                    target = os.path.join(raw_dir, "PG"+PGnumber+"_raw.txt")
 
-                    if (not os.path.isfile(target)) or overwrite:
-                        subprocess.call(["ln", "-f", source, target])
+def link_raw_files(sources, raw_dir, overwrite=False, update=None, quiet=False, workers=1):
+    """
+    Hard link the files of the books into raw_dir, as PG12345_raw.txt.
 
-            # if file was not in dupes list and we are not quiet
-            elif not quiet:
-                print("# WARNING: file %s skipped due to duplication" % fname)
+    Parameters
+    ----------
+    sources : dict
+        PG number --> path of its file in the mirror (see
+        select_mirror_files).
+    overwrite : bool
+        Whether to overwrite files in raw.
+    update : collection of str
+        PG numbers of books whose file in raw is replaced even without
+        overwrite.
+    workers : int
+        Number of threads creating the links.
+
+    Returns
+    -------
+    dict
+        Number of files linked, skipped (already in raw) and failed (could
+        not be linked).
+    """
+    existing = set(os.listdir(raw_dir)) if not overwrite else set()
+    update = set(update) if update is not None else set()
+    counts = {"linked": 0, "skipped": 0, "failed": 0}
+    to_link = {}
+    for PGnumber, source in sources.items():
+        target_name = "PG"+PGnumber+"_raw.txt"
+        if target_name in existing and PGnumber not in update:
+            counts["skipped"] += 1
+        else:
+            to_link[target_name] = source
+
+    # link them, in-process (and in threads)
+    jobs = [(source, os.path.join(raw_dir, target_name)) for target_name, source in to_link.items()]
+    if workers > 1 and len(jobs) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            errors = list(executor.map(lambda job: _link(*job), jobs))
+    else:
+        errors = [_link(source, target) for source, target in jobs]
+    for (source, target), error in zip(jobs, errors):
+        if error is None:
+            counts["linked"] += 1
+        else:
+            counts["failed"] += 1
+            if not quiet:
+                print("# WARNING: could not link %s to %s (%s)" % (source, target, error))
+    return counts
+
+
+def update_raw_from_mirror(mirror_dir=None,
+                           raw_dir=None,
+                           manifest_path=None,
+                           overwrite=False,
+                           dups_list=None,
+                           quiet=False,
+                           workers=1,
+                           index=None):
+    """
+    Populate the raw/ directory like populate_raw_from_mirror, keeping a
+    manifest of the files of the mirror and of raw/ to find the books that
+    changed since the last run.
+
+    The manifest (see src.manifest.file_records) has the path, size, mtime,
+    inode and content hash of the file of every book in the mirror and in
+    raw/. Only the files that are new, or whose inode, size or mtime
+    changed, are hashed; the files in raw/ are links to those of the mirror,
+    so they are not hashed again. The books whose file in the mirror changed
+    are linked again into raw/.
+
+    Parameters
+    ----------
+    manifest_path : str
+        Path of the manifest (json). Created if it does not exist, in which
+        case all the books in raw/ are new.
+    overwrite, dups_list, workers, index :
+        See populate_raw_from_mirror.
+
+    Returns
+    -------
+    dict, dict
+        The changeset: new and changed books of raw/ and books deleted
+        from the mirror (as sorted lists of PG ids, e.g. "PG12345"), and
+        the counts of populate_raw_from_mirror.
+    """
+    from .manifest import load_manifest, save_manifest, file_records, diff_records
+
+    manifest = load_manifest(manifest_path)
+    old_mirror, old_raw = manifest.get("mirror", {}), manifest.get("raw", {})
+
+    files = index.iter_files() if index is not None else _iter_files(mirror_dir)
+    sources, n_duplicates = select_mirror_files(files, dups_list=dups_list, quiet=quiet)
+    mirror = file_records(
+        dict(("PG"+PGnumber, source) for PGnumber, source in sources.items()),
+        previous=[old_mirror, old_raw], workers=workers)
 
+    # relink the books whose file in the mirror is another one, or changed
+    update = [PG_id[2:] for PG_id, record in mirror.items() if PG_id in old_mirror and
+              (record["path"], record["sha1"]) != (old_mirror[PG_id]["path"], old_mirror[PG_id]["sha1"])]
+    counts = link_raw_files(sources, raw_dir, overwrite=overwrite, update=update,
+                            quiet=quiet, workers=workers)
+    counts["duplicates"] = n_duplicates
 
+    raw = file_records(
+        dict((fname.split("_")[0], os.path.join(raw_dir, fname))
+             for fname in os.listdir(raw_dir) if fnmatch.fnmatchcase(fname, "PG*_raw.txt")),
+        previous=[mirror, old_raw], workers=workers)
 
+    changeset = diff_records(old_raw, raw)
+    # files in raw/ are not deleted with the books of the mirror
+    changeset["deleted"] = sorted(set(changeset["deleted"]) | set(diff_records(old_mirror, mirror)["deleted"]))
+    save_manifest({"mirror": mirror, "raw": raw}, manifest_path)
+    return changeset, counts
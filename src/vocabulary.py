@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Corpus-wide vocabulary: a map between words and integer ids.
+
+The vocabulary is stored as a UTF-8 text file with one word per line; the
+id of a word is its line number (starting at 0). The file is only ever
+appended to, so ids never change once assigned. Appends are done under an
+exclusive lock on the file, so several processes can share a vocabulary.
+"""
+import fcntl
+import io
+import os
+
+import numpy as np
+
+
+class Vocabulary(object):
+
+    def __init__(self, path):
+        '''path: the vocabulary file. It is created when the first word is added.
+        '''
+        self.path = path
+        self.words = []  ## id --> word
+        self.word_to_id = {}  ## word --> id
+        self._offset = 0  ## bytes of the file read so far
+        self._sync()
+
+    def __len__(self):
+        return len(self.words)
+
+    def _sync(self):
+        '''read the words appended to the file since it was last read
+        '''
+        if not os.path.isfile(self.path):
+            return
+        with io.open(self.path, "rb") as f:
+            f.seek(self._offset)
+            data = f.read()
+        # only consider complete lines
+        end = data.rfind(b"\n") + 1
+        for word in data[:end].decode("UTF-8").split("\n")[:-1]:
+            self.word_to_id[word] = len(self.words)
+            self.words.append(word)
+        self._offset += end
+
+    def lookup(self, words, add=True):
+        '''Ids of a sequence of words, as an array of uint32.
+
+        add: if True, words not in the vocabulary are added to it.
+        Otherwise, a KeyError is raised for unknown words.
+        '''
+        if add:
+            missing = [w for w in dict.fromkeys(words) if w not in self.word_to_id]
+            if len(missing) > 0:
+                self._add(missing)
+        word_to_id = self.word_to_id
+        return np.fromiter(
+            (word_to_id[w] for w in words), dtype=np.uint32, count=len(words))
+
+    def _add(self, words):
+        for w in words:
+            if "\n" in w or "\r" in w:
+                raise ValueError("Words can not contain line breaks: %r" % w)
+        with io.open(self.path, "ab") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                # other processes may have added some of the words meanwhile
+                self._sync()
+                new = [w for w in words if w not in self.word_to_id]
+                if len(new) > 0:
+                    f.write(("\n".join(new) + "\n").encode("UTF-8"))
+                    f.flush()
+                self._sync()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def decode(self, ids):
+        '''Words corresponding to a sequence of ids.
+        '''
+        if len(ids) > 0 and int(np.max(ids)) >= len(self.words):
+            # ids added by another process
+            self._sync()
+        words = self.words
+        return [words[i] for i in ids]
+
+
+## vocabularies opened so far in this process, by path
+_vocabularies = {}
+
+
+def get_vocabulary(path):
+    '''Return the Vocabulary stored in path, opening it only once per process.
+    '''
+    path = os.path.abspath(path)
+    if path not in _vocabularies:
+        _vocabularies[path] = Vocabulary(path)
+    return _vocabularies[path]
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of src.cleanup: the compiled marker lookup against the loop over
+all the markers it replaced, and strip_headers against its streaming
+version and the original line loop.
+
+Run from the root of the repository with python -m pytest tests.
+"""
+import io
+import os
+
+import pytest
+
+from src import cleanup
+from src.benchmarks import make_book
+from src.cleanup import strip_headers, iter_strip_headers
+
+MARKER_SETS = (
+    (cleanup.TEXT_START, cleanup.TEXT_START_MARKERS),
+    (cleanup.TEXT_END, cleanup.TEXT_END_MARKERS),
+    (cleanup.LEGALESE_START, cleanup.LEGALESE_START_MARKERS),
+    (cleanup.LEGALESE_END, cleanup.LEGALESE_END_MARKERS),
+)
+MARKERS = sorted(set().union(*[markers for _, markers in MARKER_SETS]))
+
+
+def reference_flags(line):
+    '''The flags of the markers the line starts with, one any(startswith)
+    loop per set of markers.
+    '''
+    found = 0
+    for flag, markers in MARKER_SETS:
+        if any(line.startswith(token) for token in markers):
+            found |= flag
+    return found
+
+
+def reference_strip_headers(text):
+    '''strip_headers as it was before the compiled lookup.
+    '''
+    lines = text.splitlines()
+    sep = str(os.linesep)
+
+    out = []
+    i = 0
+    footer_found = False
+    ignore_section = False
+
+    for line in lines:
+        reset = False
+        if i <= 600:
+            if any(line.startswith(token) for token in cleanup.TEXT_START_MARKERS):
+                reset = True
+            if reset:
+                out = []
+                continue
+        if i >= 100:
+            if any(line.startswith(token) for token in cleanup.TEXT_END_MARKERS):
+                footer_found = True
+            if footer_found:
+                break
+        if any(line.startswith(token) for token in cleanup.LEGALESE_START_MARKERS):
+            ignore_section = True
+            continue
+        elif any(line.startswith(token) for token in cleanup.LEGALESE_END_MARKERS):
+            ignore_section = False
+            continue
+        if not ignore_section:
+            out.append(line.rstrip(sep))
+            i += 1
+
+    return sep.join(out)
+
+
+def streamed_strip_headers(text):
+    '''strip_headers through iter_strip_headers on a file, as process_book
+    uses it.
+    '''
+    with io.StringIO(text, newline=None) as f:
+        return str(os.linesep).join(iter_strip_headers(f))
+
+
+def near_misses(marker):
+    '''Lines that start like marker but are not marker.
+    '''
+    lines = [marker[:k] for k in range(len(marker))]
+    lines.append(marker[:-1] + chr(ord(marker[-1]) + 1))
+    lines.append(marker[:1] + "x" + marker[2:])
+    lines += [" " + marker, "\ufeff" + marker, "\t" + marker, marker.lower(),
+              marker.swapcase()]
+    return lines
+
+
+@pytest.mark.parametrize("marker", MARKERS)
+def test_marker_flags_of_markers(marker):
+    for line in (marker, marker + " A BOOK ***", marker + marker, marker + "\n"):
+        assert cleanup.marker_flags(line) == reference_flags(line), line
+    assert cleanup.marker_flags(marker) != 0
+
+
+@pytest.mark.parametrize("marker", MARKERS)
+def test_marker_flags_of_near_misses(marker):
+    for line in near_misses(marker):
+        assert cleanup.marker_flags(line) == reference_flags(line), line
+
+
+def test_marker_flags_of_markers_starting_with_others():
+    # a marker can start with another one, of another set
+    for a in MARKERS:
+        for b in MARKERS:
+            for line in (a + b, a[:-1] + b):
+                assert cleanup.marker_flags(line) == reference_flags(line), line
+
+
+def test_marker_flags_of_other_lines():
+    lines = ["", " ", "*", "**", "***", "*** ", "<<", "End", "END", " "]
+    lines += make_book(50000, seed=1).splitlines()
+    for line in lines:
+        assert cleanup.marker_flags(line) == reference_flags(line), line
+
+
+BOOKS = [
+    "",
+    "\n",
+    "no markers at all\nat all\n",
+    make_book(2000, seed=0),
+    make_book(20000, seed=1),
+    make_book(100000, seed=2, long_lines=False),
+    make_book(100000, seed=3, legalese=False),
+    make_book(20000, seed=4).replace("\n", "\r\n"),
+    make_book(20000, seed=5).replace("\n", "\r"),
+    # line breaks splitlines knows but file iteration does not
+    make_book(20000, seed=6).replace("\n\n", "\n\x0c \n"),
+    # no end of the header, no footer
+    "\n".join("line %d" % i for i in range(2000)),
+    # a second header end after 600 lines is kept
+    "*** START OF THIS PROJECT GUTENBERG EBOOK A ***\n"
+    + "\n".join("line %d" % i for i in range(700))
+    + "\n*** START OF THIS PROJECT GUTENBERG EBOOK A ***\nlast\n",
+    # a footer in the first 100 lines is kept
+    "*** START OF THIS PROJECT GUTENBERG EBOOK A ***\nfirst\n"
+    "*** END OF THIS PROJECT GUTENBERG EBOOK A ***\n"
+    + "\n".join("line %d" % i for i in range(200))
+    + "\n*** END OF THIS PROJECT GUTENBERG EBOOK A ***\nfooter\n",
+    # legalese never closed
+    "*** START OF THIS PROJECT GUTENBERG EBOOK A ***\nfirst\n"
+    "<<THIS ELECTRONIC VERSION OF\nhidden\n",
+]
+
+
+@pytest.mark.parametrize("text", BOOKS)
+def test_strip_headers_matches_reference(text):
+    assert strip_headers(text) == reference_strip_headers(text)
+
+
+@pytest.mark.parametrize("text", BOOKS)
+def test_streaming_strip_headers(text):
+    assert streamed_strip_headers(text) == strip_headers(text)
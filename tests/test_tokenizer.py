@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of src.tokenizer: tokenize_text_fast must give exactly the tokens of
+tokenize_text (the Treebank tokenizer followed by filter_tokens).
+
+Run from the root of the repository with python -m pytest tests.
+"""
+import io
+import os
+
+import pytest
+
+from src import tokenizer
+from src.benchmarks import make_book
+from src.tokenizer import (tokenize_text, tokenize_text_fast, filter_tokens,
+                           tokenize_sentence_fast, get_sentence_tokenizer,
+                           get_word_tokenizer, iter_tokenize_chunks,
+                           iter_tokenize_chunks_fast, clear_piece_cache)
+
+SAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "tokenizer_sample.txt")
+
+TEXTS = [
+    "",
+    " ",
+    "\n\n",
+    "word",
+    "Word.",
+    # contractions
+    "I can't, won't, shouldn't and you'd've; cannot gonna gotta gimme lemme wanna.",
+    "CANNOT Gonna GOTTA, 'tis 'twas, o'clock y'all rock'n'roll ain't.",
+    # quotes
+    '"Hello," she said. "Goodbye!" \'Single\' ``double\'\' ‘curly’ “curly” «guillemets»',
+    "The boss's hat and the bosses' hats; it's theirs'.",
+    # dashes
+    "He waited--and waited -- and -- then-- left --now.",
+    "---- -- - word-word word--word",
+    # non-ASCII letters
+    "Café naïve façade Ægir Œuvre straße Größe İstanbul ПРИВЕТ Ελλάδα 東京 عربي.",
+    # digits inside words
+    "x2 2x a1b2 R2-D2 C-3PO 1984 3rd 1st $4.50 10:30 4th.",
+    # punctuation only, odd spacing
+    "!!! ??? ... ;;; ::: ''' \"\"\"",
+    "Two  spaces,\ta tab, trailing spaces   ",
+    "No.Space!After?Punctuation",
+    # the private use character the fast path splits pieces with
+    "a \ue000 b, a\ue000b",
+]
+
+
+@pytest.fixture(autouse=True)
+def empty_piece_cache():
+    clear_piece_cache()
+    yield
+    clear_piece_cache()
+
+
+def reference_tokens(text):
+    '''The Treebank tokens of the Punkt sentences of text, filtered once
+    (filter_tokens is not idempotent: "İ".lower() is not alphabetic).
+    '''
+    word_tokenizer = get_word_tokenizer()
+    list_tokens = []
+    for start, end in get_sentence_tokenizer("english").span_tokenize(text):
+        list_tokens += filter_tokens(word_tokenizer.tokenize(text[start:end]))
+    assert list_tokens == tokenize_text(text)
+    return list_tokens
+
+
+@pytest.mark.parametrize("text", TEXTS)
+def test_fast_tokens(text):
+    assert tokenize_text_fast(text) == reference_tokens(text)
+    # again, with the pieces in the cache
+    assert tokenize_text_fast(text) == reference_tokens(text)
+
+
+@pytest.mark.parametrize("text", TEXTS)
+def test_fast_sentence_tokens(text):
+    # the fast path applies to any string, not only to Punkt sentences
+    expected = filter_tokens(get_word_tokenizer().tokenize(text))
+    assert tokenize_sentence_fast(text) == expected
+    assert tokenize_sentence_fast(text) == expected
+
+
+def read_sample():
+    with io.open(SAMPLE, encoding="UTF-8") as f:
+        return f.read()
+
+
+def test_fast_tokens_of_sample():
+    text = read_sample()
+    expected = reference_tokens(text)
+    assert len(expected) > 100
+    assert tokenize_text_fast(text) == expected
+    assert tokenize_text_fast(text) == expected
+
+
+def test_fast_tokens_of_sample_lines():
+    # every line on its own, so that each is the start and end of a sentence
+    for line in read_sample().splitlines():
+        assert tokenize_text_fast(line) == reference_tokens(line), line
+
+
+def test_fast_tokens_of_book():
+    text = make_book(100000, seed=0)
+    assert tokenize_text_fast(text) == reference_tokens(text)
+
+
+def test_fast_tokens_with_small_cache(monkeypatch):
+    # the caches are emptied many times while tokenizing
+    monkeypatch.setattr(tokenizer, "PIECE_CACHE_SIZE", 5)
+    text = read_sample() + make_book(20000, seed=1)
+    assert tokenize_text_fast(text) == reference_tokens(text)
+
+
+def test_fast_tokens_in_chunks():
+    text = read_sample() + make_book(20000, seed=2)
+    expected = list(iter_tokenize_chunks(text, chunk_size=500))
+    assert list(iter_tokenize_chunks_fast(text, chunk_size=500)) == expected